@@ -6,8 +6,11 @@ from pyproj import Transformer
 import rasterio
 from rasterio.warp import transform_bounds
 import os
-import matplotlib.pyplot as plt
-from scipy.ndimage import binary_dilation
+import sys
+from PIL import Image
+# Mask dilation and TPI colouring are shared with the overlay scripts in ../visualization
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "visualization"))
+from overlay_rendering import dilate_mask, tpi_colormap_lut, tpi_to_rgba
 
 # --- Configuration ---
 project_base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -108,20 +111,24 @@ def process_submit_data(df, filepath):
     return df
 
 # --- Helper: Get Raster Bounds ---
+def dataset_folium_bounds(src, tiff_path):
+    """[[south, west], [north, east]] in lat/lon for an open rasterio dataset."""
+    if src.crs.is_geographic:
+        bounds = src.bounds
+        folium_bounds = [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
+    else:
+        wgs84_bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+        folium_bounds = [[wgs84_bounds[1], wgs84_bounds[0]], [wgs84_bounds[3], wgs84_bounds[2]]]
+    print(f"  Bounds for {os.path.basename(tiff_path)} (lat/lon for Folium): {folium_bounds}")
+    return folium_bounds
+
 def get_raster_bounds(tiff_path):
     if not os.path.exists(tiff_path):
         print(f"Error: Reference TIFF not found at {tiff_path}")
         return None
     try:
         with rasterio.open(tiff_path) as src:
-            if src.crs.is_geographic:
-                bounds = src.bounds
-                folium_bounds = [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
-            else:
-                wgs84_bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
-                folium_bounds = [[wgs84_bounds[1], wgs84_bounds[0]], [wgs84_bounds[3], wgs84_bounds[2]]]
-            print(f"  Bounds for {os.path.basename(tiff_path)} (lat/lon for Folium): {folium_bounds}")
-            return folium_bounds
+            return dataset_folium_bounds(src, tiff_path)
     except Exception as e:
         print(f"Error reading bounds from {tiff_path}: {e}")
         return None
@@ -132,12 +139,12 @@ def create_enhanced_overlay_png(source_tiff_path, target_png_path,
                                 dilation_iterations=0, nodata_val=None):
     if not os.path.exists(source_tiff_path):
         print(f"Error: Overlay source TIFF not found at {source_tiff_path}")
-        return False
+        return False, None
     try:
         with rasterio.open(source_tiff_path) as src:
             data = src.read(1)
             height, width = data.shape
-            rgba = np.zeros((height, width, 4), dtype=np.uint8)
+            rgba = np.empty((height, width, 4), dtype=np.uint8) # Every branch below writes every pixel, so no zero-fill
 
             effective_nodata_val_generic = nodata_val
             if effective_nodata_val_generic is None:
@@ -152,16 +159,13 @@ def create_enhanced_overlay_png(source_tiff_path, target_png_path,
                 binary_mask = (data == 1) # Assumes interfluves/streams are value 1
 
                 if dilation_iterations > 0:
-                    mask_to_color = binary_dilation(binary_mask, iterations=dilation_iterations)
+                    mask_to_color = dilate_mask(binary_mask, dilation_iterations)
                     print(f"    Applied dilation with {dilation_iterations} iterations.")
                 else:
                     mask_to_color = binary_mask
 
-                if color:
-                    rgba[mask_to_color, 0] = color[0]
-                    rgba[mask_to_color, 1] = color[1]
-                    rgba[mask_to_color, 2] = color[2]
-                rgba[mask_to_color, 3] = alpha
+                fill_rgba = np.array((color[0], color[1], color[2], alpha) if color else (0, 0, 0, alpha), dtype=np.uint8)
+                np.multiply(mask_to_color[..., None], fill_rgba, out=rgba) # Fill color inside the mask, 0 elsewhere, one pass
 
             elif is_tpi:
                 print("  Applying TPI colormap...")
@@ -176,45 +180,34 @@ def create_enhanced_overlay_png(source_tiff_path, target_png_path,
                      vmax_tpi = np.percentile(valid_data_tpi, 95)
                 if vmin_tpi == vmax_tpi: vmin_tpi -=1; vmax_tpi +=1
 
-                norm_tpi = plt.Normalize(vmin=vmin_tpi, vmax=vmax_tpi)
-                colormap = plt.cm.RdBu_r
-                colored_tpi = colormap(norm_tpi(data))
-
-                alpha_channel_tpi = np.ones_like(data, dtype=float) * (alpha / 255.0)
-                alpha_channel_tpi[np.abs(data) < 0.25] = 0.1 * (alpha / 255.0)
-
-                rgba[:,:,0] = (colored_tpi[:,:,0] * 255).astype(np.uint8)
-                rgba[:,:,1] = (colored_tpi[:,:,1] * 255).astype(np.uint8)
-                rgba[:,:,2] = (colored_tpi[:,:,2] * 255).astype(np.uint8)
-                rgba[:,:,3] = (alpha_channel_tpi * 255).astype(np.uint8)
-
-                nodata_mask_for_tpi = (data == tpi_nodata_val) if not np.isnan(tpi_nodata_val) else np.isnan(data)
-                rgba[nodata_mask_for_tpi, 3] = 0
+                # Colormap, flat-area alpha and nodata mask in one compiled pass (same bytes as the matplotlib path)
+                tpi_to_rgba(data, float(vmin_tpi), float(vmax_tpi), tpi_colormap_lut,
+                            np.uint8((alpha / 255.0) * 255), np.uint8((0.1 * (alpha / 255.0)) * 255),
+                            True, float(tpi_nodata_val), rgba)
 
             else: # Generic case
                 print(f"  Applying generic binary/single-color logic with dilation: {dilation_iterations} iterations...")
                 binary_mask = (data != effective_nodata_val_generic) if not np.isnan(effective_nodata_val_generic) else ~np.isnan(data)
 
                 if dilation_iterations > 0:
-                    mask_to_color = binary_dilation(binary_mask, iterations=dilation_iterations)
+                    mask_to_color = dilate_mask(binary_mask, dilation_iterations)
                     print(f"    Applied dilation with {dilation_iterations} iterations.")
                 else:
                     mask_to_color = binary_mask
 
-                if color:
-                    rgba[mask_to_color, 0] = color[0]
-                    rgba[mask_to_color, 1] = color[1]
-                    rgba[mask_to_color, 2] = color[2]
-                rgba[mask_to_color, 3] = alpha
+                fill_rgba = np.array((color[0], color[1], color[2], alpha) if color else (0, 0, 0, alpha), dtype=np.uint8)
+                np.multiply(mask_to_color[..., None], fill_rgba, out=rgba) # Fill color inside the mask, 0 elsewhere, one pass
             
-            plt.imsave(target_png_path, rgba)
+            # rgba is already the final uint8 image, so it is written straight to PNG (no matplotlib figure/Agg
+            # round trip); the overlay is mostly empty, so fast compression costs little size
+            Image.fromarray(rgba, 'RGBA').save(target_png_path, compress_level=1)
             print(f"  Enhanced overlay PNG created at {target_png_path}")
-            return True
+            return True, dataset_folium_bounds(src, source_tiff_path)
     except Exception as e:
         print(f"Error creating enhanced overlay PNG from {source_tiff_path}: {e}")
         import traceback
         traceback.print_exc()
-        return False
+        return False, None
 
 # --- Main Combined Function ---
 def create_combined_map():
@@ -270,21 +263,19 @@ def create_combined_map():
     
     print(f"  Overlay Type: {overlay_type_name}, Dilation: {current_dilation}, Alpha: {current_overlay_alpha}")
 
-    if not create_enhanced_overlay_png(
+    # The overlay's placement bounds come back with the PNG, read from the same open dataset
+    raster_overlay_available, overlay_placement_bounds = create_enhanced_overlay_png(
         OVERLAY_SOURCE_TIFF_PATH,
         TEMP_OVERLAY_PNG_PATH,
         color=current_overlay_color,
         alpha=current_overlay_alpha,
         dilation_iterations=current_dilation
         # nodata_val is handled inside create_enhanced_overlay_png based on type
-    ):
+    )
+    if not raster_overlay_available:
         print("ERROR: Failed to create raster overlay PNG. Overlay will be skipped.")
-        raster_overlay_available = False
-    else:
-        raster_overlay_available = True
 
     map_fit_bounds = get_raster_bounds(REFERENCE_BOUNDS_TIFF_PATH)
-    overlay_placement_bounds = get_raster_bounds(OVERLAY_SOURCE_TIFF_PATH) if raster_overlay_available else None
 
     # 3. Create Folium Map
     print("\n--- Creating Folium Map ---")
@@ -12,8 +12,9 @@ if __name__ == "__main__":
         print(f"ERROR: Shapefile not found at: {shapefile_path}")
     else:
         try:
-            # Read the shapefile
-            gdf = geopandas.read_file(shapefile_path)
+            # Read the shapefile (pyogrio reads all features in one vectorized GDAL call
+            # instead of Fiona's per-feature Python loop; use_arrow needs pyarrow)
+            gdf = geopandas.read_file(shapefile_path, engine="pyogrio", use_arrow=True)
 
             # Check if CRS is already WGS84, if not, reproject
             # Natural Earth data is typically already in EPSG:4326 (WGS84)
@@ -27,7 +28,7 @@ if __name__ == "__main__":
 
             # Save to GeoJSON
             # When saving to GeoJSON, geopandas should default to WGS84 if the gdf is in WGS84
-            gdf.to_file(output_geojson_path, driver="GeoJSON")
+            gdf.to_file(output_geojson_path, driver="GeoJSON", engine="pyogrio")
             print(f"Successfully converted Shapefile to GeoJSON: {output_geojson_path}")
             print("You can now use this GeoJSON file in your Folium script.")
         except Exception as e:
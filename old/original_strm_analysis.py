@@ -2,12 +2,18 @@
 
 import ee
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.features import shapes
 import numpy as np
+import geopandas as gpd
+from shapely.geometry import shape
 from pysheds.grid import Grid
-from scipy.ndimage import generic_filter, distance_transform_edt
-import matplotlib.pyplot as plt
+from scipy.ndimage import distance_transform_edt
+from numba import njit, prange
 import os
+import shutil
+import zipfile # For handling ZIP files
+import requests
+from concurrent.futures import ThreadPoolExecutor
 import time # To handle potential GEE export delays
 from dotenv import load_dotenv # Import the library
 
@@ -66,151 +72,169 @@ aoi_geometry_gee = ee.Geometry.Polygon(aoi_coordinates_gee)
 
 gee_dem_path = os.path.join(output_dir, 'gee_srtm_aoi.tif') # Path to save downloaded DEM
 
-# --- 2. Acquire DEM from Google Earth Engine ---
-print("Acquiring SRTM DEM from Google Earth Engine...")
-# SRTM 1 Arc-Second Global, Version 3
-srtm = ee.Image('USGS/SRTMGL1_003')
-
-# Clip the SRTM image to your AOI
-srtm_aoi = srtm.clip(aoi_geometry_gee)
-
-# Get information about the projection of the SRTM image to use for export
-# We'll export in its native projection to start
-projection_info = srtm.projection().getInfo()
-crs_gee = projection_info['crs']
-transform_gee = projection_info['transform'] # This is affine transform [scaleX, shearX, translateX, shearY, scaleY, translateY]
-
-print(f"GEE SRTM native CRS: {crs_gee}")
-print(f"GEE SRTM native transform: {transform_gee}")
-
-# Export the clipped DEM to Google Drive (or directly download if small enough)
-# For larger areas, exporting to Drive is more robust.
-# We'll attempt direct download here using getDownloadURL for simplicity,
-# but this might time out or fail for very large AOIs.
-task_config = {
-    'image': srtm_aoi.select('elevation'), # Select the elevation band
-    'description': 'SRTM_AOI_Export',
-    'scale': 30, # Approximate scale of SRTM 1-arcsec in meters
-    'region': aoi_geometry_gee,
-    'fileFormat': 'GeoTIFF',
-    # 'crs': crs_gee, # Export in native projection
-    # 'crsTransform': transform_gee # Using scale is often simpler
-}
-
-# --- Option A: Direct Download (may fail for large AOIs or return ZIP) ---
+# --- Reuse a previously downloaded DEM if it already covers the AOI at ~30 m ---
 download_success = False
 actual_dem_path_for_pysheds = gee_dem_path # Assume it's the direct path initially
+aoi_min_lon = min(coord[0] for coord in aoi_coordinates_gee)
+aoi_max_lon = max(coord[0] for coord in aoi_coordinates_gee)
+aoi_min_lat = min(coord[1] for coord in aoi_coordinates_gee)
+aoi_max_lat = max(coord[1] for coord in aoi_coordinates_gee)
+if os.path.exists(gee_dem_path):
+    try:
+        with rasterio.open(gee_dem_path) as cached_dem:
+            res_x, res_y = cached_dem.res
+            cached_bounds = cached_dem.bounds
+            # Allow half a pixel of slack on each edge; in EPSG:4326, 1 degree is ~111320 m
+            covers_aoi = (cached_bounds.left <= aoi_min_lon + res_x / 2 and cached_bounds.right >= aoi_max_lon - res_x / 2 and
+                          cached_bounds.bottom <= aoi_min_lat + res_y / 2 and cached_bounds.top >= aoi_max_lat - res_y / 2)
+            expected_res = 30 / 111320 if cached_dem.crs and cached_dem.crs.is_geographic else 30
+            matches_scale = all(abs(res - expected_res) <= 0.1 * expected_res for res in (res_x, res_y))
+        if covers_aoi and matches_scale:
+            download_success = True
+            print(f"Reusing existing DEM {gee_dem_path} (covers AOI at ~30 m). Delete it to force a new download.")
+        else:
+            print(f"Existing DEM {gee_dem_path} does not match the AOI/scale, downloading again.")
+    except rasterio.errors.RasterioIOError:
+        print(f"Existing file {gee_dem_path} is not a valid GeoTIFF, downloading again.")
 
-try:
-    print("Attempting direct download from GEE...")
-    if not isinstance(srtm_aoi, ee.Image):
-        print("Error: srtm_aoi is not an ee.Image object.")
-        raise Exception("Invalid GEE Image object for download")
-    
-    image_to_download = srtm_aoi.select('elevation')
-
-    download_url = image_to_download.getDownloadURL({
-        'scale': 30,
+# --- 2. Acquire DEM from Google Earth Engine ---
+if not download_success:
+    print("Acquiring SRTM DEM from Google Earth Engine...")
+    # SRTM 1 Arc-Second Global, Version 3
+    srtm = ee.Image('USGS/SRTMGL1_003')
+
+    # Clip the SRTM image to your AOI
+    srtm_aoi = srtm.clip(aoi_geometry_gee)
+
+    # Native projection of the SRTM image, hard-coded to save a synchronous getInfo() round-trip per run.
+    # It never changes for this asset; regenerate with srtm.projection().getInfo() if the asset is swapped.
+    crs_gee = 'EPSG:4326'
+    transform_gee = [0.0002777777777777778, 0, -180.0001388888889, 0, -0.0002777777777777778, 60.00013888888889] # [scaleX, shearX, translateX, shearY, scaleY, translateY]
+
+    print(f"GEE SRTM native CRS: {crs_gee}")
+    print(f"GEE SRTM native transform: {transform_gee}")
+
+    # Export the clipped DEM to Google Drive (or directly download if small enough)
+    # For larger areas, exporting to Drive is more robust.
+    # We'll attempt direct download here using getDownloadURL for simplicity,
+    # but this might time out or fail for very large AOIs.
+    task_config = {
+        'image': srtm_aoi.select('elevation'), # Select the elevation band
+        'description': 'SRTM_AOI_Export',
+        'scale': 30, # Approximate scale of SRTM 1-arcsec in meters
         'region': aoi_geometry_gee,
-        'format': 'GEO_TIFF' # Request GeoTIFF
-    })
-    
-    print(f"Generated download URL: {download_url[:100]}...")
-
-    import requests
-    import shutil
-    import zipfile # For handling ZIP files
-
-    with requests.Session() as session:
-        response = session.get(download_url, stream=True, timeout=300)
-    
-    print(f"Download response status code: {response.status_code}")
-    content_type = response.headers.get('Content-Type', '').lower()
-    print(f"Download response content-type: {content_type}")
-
-    if response.status_code == 200:
-        temp_download_path = gee_dem_path + ".download" # Download to a temp name
-        with open(temp_download_path, 'wb') as f:
-            shutil.copyfileobj(response.raw, f)
-        print(f"SRTM DEM for AOI potentially downloaded to {temp_download_path}")
-
-        # Check if it's a ZIP file
-        if 'zip' in content_type or zipfile.is_zipfile(temp_download_path):
-            print("Downloaded file is a ZIP archive. Extracting...")
-            with zipfile.ZipFile(temp_download_path, 'r') as zip_ref:
-                # Find the .tif file within the zip
-                tif_files_in_zip = [name for name in zip_ref.namelist() if name.lower().endswith('.tif')]
-                if tif_files_in_zip:
-                    extracted_tif_name = tif_files_in_zip[0] # Assume the first .tif is the one we want
-                    zip_ref.extract(extracted_tif_name, path=output_dir)
-                    # Rename the extracted file to our expected gee_dem_path
-                    # or ensure actual_dem_path_for_pysheds points to it
-                    extracted_file_full_path = os.path.join(output_dir, extracted_tif_name)
-                    if os.path.exists(gee_dem_path) and gee_dem_path != extracted_file_full_path:
-                         os.remove(gee_dem_path) # Remove if it was a placeholder or previous bad download
-                    if gee_dem_path != extracted_file_full_path:
-                        os.rename(extracted_file_full_path, gee_dem_path)
-
-                    actual_dem_path_for_pysheds = gee_dem_path
-                    print(f"Extracted '{extracted_tif_name}' to '{actual_dem_path_for_pysheds}'")
-                else:
-                    print("Error: ZIP file downloaded, but no .tif file found inside.")
+        'fileFormat': 'GeoTIFF',
+        # 'crs': crs_gee, # Export in native projection
+        # 'crsTransform': transform_gee # Using scale is often simpler
+    }
+
+    # --- Option A: Direct Download (may fail for large AOIs or return ZIP) ---
+    try:
+        print("Attempting direct download from GEE...")
+        if not isinstance(srtm_aoi, ee.Image):
+            print("Error: srtm_aoi is not an ee.Image object.")
+            raise Exception("Invalid GEE Image object for download")
+
+        image_to_download = srtm_aoi.select('elevation')
+
+        download_url = image_to_download.getDownloadURL({
+            'scale': 30,
+            'region': aoi_geometry_gee,
+            'format': 'GEO_TIFF' # Request GeoTIFF
+        })
+
+        print(f"Generated download URL: {download_url[:100]}...")
+
+        with requests.Session() as session:
+            response = session.get(download_url, stream=True, timeout=300)
+
+        print(f"Download response status code: {response.status_code}")
+        content_type = response.headers.get('Content-Type', '').lower()
+        print(f"Download response content-type: {content_type}")
+
+        if response.status_code == 200:
+            temp_download_path = gee_dem_path + ".download" # Download to a temp name
+            with open(temp_download_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f)
+            print(f"SRTM DEM for AOI potentially downloaded to {temp_download_path}")
+
+            # Check if it's a ZIP file
+            if 'zip' in content_type or zipfile.is_zipfile(temp_download_path):
+                print("Downloaded file is a ZIP archive. Extracting...")
+                with zipfile.ZipFile(temp_download_path, 'r') as zip_ref:
+                    # Find the .tif file within the zip
+                    tif_files_in_zip = [name for name in zip_ref.namelist() if name.lower().endswith('.tif')]
+                    if tif_files_in_zip:
+                        extracted_tif_name = tif_files_in_zip[0] # Assume the first .tif is the one we want
+                        zip_ref.extract(extracted_tif_name, path=output_dir)
+                        # Rename the extracted file to our expected gee_dem_path
+                        # or ensure actual_dem_path_for_pysheds points to it
+                        extracted_file_full_path = os.path.join(output_dir, extracted_tif_name)
+                        if os.path.exists(gee_dem_path) and gee_dem_path != extracted_file_full_path:
+                             os.remove(gee_dem_path) # Remove if it was a placeholder or previous bad download
+                        if gee_dem_path != extracted_file_full_path:
+                            os.rename(extracted_file_full_path, gee_dem_path)
+
+                        actual_dem_path_for_pysheds = gee_dem_path
+                        print(f"Extracted '{extracted_tif_name}' to '{actual_dem_path_for_pysheds}'")
+                    else:
+                        print("Error: ZIP file downloaded, but no .tif file found inside.")
+                        download_success = False
+                os.remove(temp_download_path) # Clean up the zip file
+            else:
+                # Not a zip, assume it's the direct GeoTIFF, rename it
+                if os.path.exists(gee_dem_path) and gee_dem_path != temp_download_path:
+                     os.remove(gee_dem_path)
+                os.rename(temp_download_path, gee_dem_path)
+                actual_dem_path_for_pysheds = gee_dem_path
+
+            # Verify the final DEM file (either extracted or directly downloaded)
+            if os.path.exists(actual_dem_path_for_pysheds):
+                try:
+                    with rasterio.open(actual_dem_path_for_pysheds) as test_ds:
+                        print(f"Successfully opened final GeoTIFF: {test_ds.count} band(s), {test_ds.width}x{test_ds.height} pixels.")
+                    download_success = True
+                except rasterio.errors.RasterioIOError:
+                    print(f"Error: Final file {actual_dem_path_for_pysheds} is not a valid GeoTIFF.")
+                    if os.path.exists(actual_dem_path_for_pysheds): os.remove(actual_dem_path_for_pysheds)
                     download_success = False
-            os.remove(temp_download_path) # Clean up the zip file
-        else:
-            # Not a zip, assume it's the direct GeoTIFF, rename it
-            if os.path.exists(gee_dem_path) and gee_dem_path != temp_download_path:
-                 os.remove(gee_dem_path)
-            os.rename(temp_download_path, gee_dem_path)
-            actual_dem_path_for_pysheds = gee_dem_path
-        
-        # Verify the final DEM file (either extracted or directly downloaded)
-        if os.path.exists(actual_dem_path_for_pysheds):
-            try:
-                with rasterio.open(actual_dem_path_for_pysheds) as test_ds:
-                    print(f"Successfully opened final GeoTIFF: {test_ds.count} band(s), {test_ds.width}x{test_ds.height} pixels.")
-                download_success = True
-            except rasterio.errors.RasterioIOError:
-                print(f"Error: Final file {actual_dem_path_for_pysheds} is not a valid GeoTIFF.")
-                if os.path.exists(actual_dem_path_for_pysheds): os.remove(actual_dem_path_for_pysheds)
+            else:
+                print(f"Error: Expected DEM file {actual_dem_path_for_pysheds} not found after download/extraction attempt.")
                 download_success = False
-        else:
-            print(f"Error: Expected DEM file {actual_dem_path_for_pysheds} not found after download/extraction attempt.")
+
+        else: # response.status_code != 200
+            print(f"Failed to download directly. Status code: {response.status_code}")
+            try:
+                print(f"Error response from GEE: {response.content.decode('utf-8', errors='ignore')[:500]}")
+            except: pass
             download_success = False
-            
-    else: # response.status_code != 200
-        print(f"Failed to download directly. Status code: {response.status_code}")
-        try:
-            print(f"Error response from GEE: {response.content.decode('utf-8', errors='ignore')[:500]}")
-        except: pass
-        download_success = False
-
-    if not download_success:
-        print("Consider exporting to Google Drive for larger or problematic AOIs (Option B).")
-        raise Exception("Direct download failed or produced an invalid file.")
-
-except Exception as e_direct_download:
-    # ... (rest of the Google Drive export fallback logic as before) ...
-    print(f"Direct download from GEE failed or not chosen: {e_direct_download}")
-    print("If the error was 'Image.clip: Output of image computation is too large' or similar, your AOI is too big for direct download.")
-    print("Proceeding with Google Drive export option (ensure relevant code block is uncommented)...")
-    # --- Option B: Export to Google Drive (more robust for larger areas) ---
-    # Ensure the task_config is correctly defined if using this block
-    task_config_drive = {
-        'image': srtm_aoi.select('elevation'),
-        'description': 'SRTM_AOI_Export_Drive',
-        'scale': 30,
-        'region': aoi_geometry_gee,
-        'fileFormat': 'GeoTIFF',
-        'folder': 'GEE_Exports',
-        'fileNamePrefix': 'srtm_aoi_rondonia'
-    }
-    task = ee.batch.Export.image.toDrive(**task_config_drive)
-    task.start()
-    print(f"Exporting SRTM DEM for AOI to Google Drive. Task ID: {task.id}")
-    print("Please monitor the 'Tasks' tab in the GEE Code Editor or use 'task.status()' to check progress.")
-    print(f"Once complete, download '{task_config_drive['fileNamePrefix']}.tif' from your 'GEE_Exports' Drive folder, ensure it's named '{os.path.basename(gee_dem_path)}' in '{os.path.dirname(gee_dem_path)}', and re-run the script from step 3 (after commenting out the GEE download/export sections).")
-    exit()
+
+        if not download_success:
+            print("Consider exporting to Google Drive for larger or problematic AOIs (Option B).")
+            raise Exception("Direct download failed or produced an invalid file.")
+
+    except Exception as e_direct_download:
+        # ... (rest of the Google Drive export fallback logic as before) ...
+        print(f"Direct download from GEE failed or not chosen: {e_direct_download}")
+        print("If the error was 'Image.clip: Output of image computation is too large' or similar, your AOI is too big for direct download.")
+        print("Proceeding with Google Drive export option (ensure relevant code block is uncommented)...")
+        # --- Option B: Export to Google Drive (more robust for larger areas) ---
+        # Ensure the task_config is correctly defined if using this block
+        task_config_drive = {
+            'image': srtm_aoi.select('elevation'),
+            'description': 'SRTM_AOI_Export_Drive',
+            'scale': 30,
+            'region': aoi_geometry_gee,
+            'fileFormat': 'GeoTIFF',
+            'folder': 'GEE_Exports',
+            'fileNamePrefix': 'srtm_aoi_rondonia'
+        }
+        task = ee.batch.Export.image.toDrive(**task_config_drive)
+        task.start()
+        print(f"Exporting SRTM DEM for AOI to Google Drive. Task ID: {task.id}")
+        print("Please monitor the 'Tasks' tab in the GEE Code Editor or use 'task.status()' to check progress.")
+        print(f"Once complete, download '{task_config_drive['fileNamePrefix']}.tif' from your 'GEE_Exports' Drive folder, ensure it's named '{os.path.basename(gee_dem_path)}' in '{os.path.dirname(gee_dem_path)}', and re-run the script (the existing DEM is then reused and the GEE download is skipped).")
+        exit()
 
 
 # --- Check if DEM was downloaded and processed successfully ---
@@ -218,6 +242,13 @@ if not download_success or not os.path.exists(actual_dem_path_for_pysheds):
     print(f"Error: DEM file {actual_dem_path_for_pysheds} not found or invalid. Please ensure it was downloaded and extracted correctly.")
     exit()
 
+# Read the DEM profile and band once; every output profile below derives from base_profile
+# instead of reopening a GeoTIFF (and re-parsing its tags) just to copy its profile.
+with rasterio.open(actual_dem_path_for_pysheds) as src:
+    base_profile = src.profile.copy()
+    dem_array = src.read(1) # Native dtype (int16 for SRTM); nodata is handled with a mask, not NaN
+    dem_nodata = src.nodata
+
 # --- 3. Hydrological Analysis with PySheds ---
 print(f"Starting hydrological analysis with PySheds using: {actual_dem_path_for_pysheds}")
 grid = Grid.from_raster(actual_dem_path_for_pysheds, data_name='dem')
@@ -251,61 +282,115 @@ grid.extract_river_network(fdir=grid.fdir, acc=grid.acc, threshold=stream_thresh
 
 streams_raster = grid.streams.astype(np.uint8)
 
+# Outputs are collected as (path, array, profile) and written together at the end, see write_raster
+output_writes = []
+
+# Tiled GeoTIFF creation options: ZSTD + horizontal differencing for the 0/1 uint8 masks,
+# DEFLATE + floating-point predictor for float32 TPI (needs GDAL >= 3.2; write_raster falls back to LZW)
+uint8_creation_options = dict(compress='zstd', zstd_level=9, predictor=2, tiled=True,
+                              blockxsize=512, blockysize=512, num_threads='all_cpus')
+float32_creation_options = dict(compress='deflate', predictor=3, tiled=True,
+                                blockxsize=512, blockysize=512, num_threads='all_cpus')
+
 # Save the streams raster
 streams_path = os.path.join(output_dir, 'streams_gee.tif')
-with rasterio.open(actual_dem_path_for_pysheds) as src_meta_provider:
-    profile = src_meta_provider.profile.copy()
-    profile.update(dtype=rasterio.uint8, count=1, compress='lzw')
-    with rasterio.open(streams_path, 'w', **profile) as dst:
-        dst.write(streams_raster, 1)
-print(f"Streams raster saved to {streams_path}")
+streams_profile = base_profile.copy()
+streams_profile.update(dtype=rasterio.uint8, count=1, **uint8_creation_options)
+output_writes.append((streams_path, streams_raster, streams_profile))
 
 # --- 4. Identify Interfluve Zones (remains largely the same) ---
 
 # Method 1: Distance from Streams
 print("Calculating distance from streams...")
-binary_streams = (streams_raster > 0).astype(np.uint8)
-distance_to_streams = distance_transform_edt(1 - binary_streams)
+# One uint8 scratch buffer holds the stream mask and then, XOR'd in place, its complement
+# (the EDT input), instead of allocating the mask, its cast and '1 - mask' separately.
+scratch_u8 = np.empty(streams_raster.shape, dtype=np.uint8)
+binary_streams = np.not_equal(streams_raster, 0, out=scratch_u8)
+non_stream_mask = np.bitwise_xor(binary_streams, 1, out=scratch_u8) # binary_streams is overwritten here
+distance_to_streams = distance_transform_edt(non_stream_mask)
 distance_interfluve_threshold_pixels = 15  # EXAMPLE
 interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
 
 interfluves_dist_path = os.path.join(output_dir, 'interfluves_by_distance_gee.tif')
-with rasterio.open(streams_path) as src_meta_provider:
-    profile = src_meta_provider.profile.copy()
-    with rasterio.open(interfluves_dist_path, 'w', **profile) as dst:
-        dst.write(interfluves_by_distance, 1)
-print(f"Interfluves by distance saved to {interfluves_dist_path}")
+output_writes.append((interfluves_dist_path, interfluves_by_distance, streams_profile))
 
 
 # Method 2: Topographic Position Index (TPI)
 print("Calculating TPI...")
-with rasterio.open(gee_dem_path) as src:
-    dem_array = src.read(1).astype(np.float32) # Ensure float for calculations
-    profile = src.profile.copy()
 
 kernel_size = 9  # EXAMPLE
-pad_width = kernel_size // 2
-# Handle NaN values in DEM if any before padding/filtering, e.g., by interpolating or setting to a value
-dem_array_no_nan = np.nan_to_num(dem_array, nan=np.nanmean(dem_array)) # Example: replace NaN with mean
-
-dem_padded = np.pad(dem_array_no_nan, pad_width, mode='reflect')
 
-def mean_filter_nan_aware(arr): # TPI calculation needs to be robust to NaNs if present
-    valid_arr = arr[~np.isnan(arr)]
-    if valid_arr.size == 0:
-        return np.nan
-    return np.mean(valid_arr)
-
-mean_elevation_neighborhood = generic_filter(
-    dem_padded,
-    mean_filter_nan_aware, # Use NaN-aware mean
-    size=kernel_size,
-    mode='constant',
-    cval=np.nan
-)
-mean_elevation_neighborhood = mean_elevation_neighborhood[pad_width:-pad_width, pad_width:-pad_width]
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def tpi_kernel(dem, valid, k, acc_zero, out):
+    """
+    Writes TPI (elevation minus the mean of the valid cells in the k x k window) into out.
+    The window is truncated at the raster edges and invalid cells get NaN. Rows are split
+    into bands processed in parallel; each band keeps running column sums that slide down
+    one row at a time, so the box mean and the subtraction are a single O(N) pass.
+    acc_zero sets the accumulator type: np.int64(0) keeps int16 DEMs in exact integer sums.
+    """
+    height, width = dem.shape
+    r = k // 2
+    band_rows = 64
+    n_bands = (height + band_rows - 1) // band_rows
+    for b in prange(n_bands):
+        row_start = b * band_rows
+        row_stop = min(row_start + band_rows, height)
+        col_sum = np.full(width, acc_zero)
+        col_count = np.zeros(width, dtype=np.int64)
+        # Prime the column sums with the window rows of the band's first row
+        for ii in range(max(0, row_start - r), min(height, row_start + r + 1)):
+            for j in range(width):
+                if valid[ii, j]:
+                    col_sum[j] += dem[ii, j]
+                    col_count[j] += 1
+        for i in range(row_start, row_stop):
+            if i > row_start:
+                # Slide the window down: drop row i-r-1, add row i+r
+                row_out = i - r - 1
+                if row_out >= 0:
+                    for j in range(width):
+                        if valid[row_out, j]:
+                            col_sum[j] -= dem[row_out, j]
+                            col_count[j] -= 1
+                row_in = i + r
+                if row_in < height:
+                    for j in range(width):
+                        if valid[row_in, j]:
+                            col_sum[j] += dem[row_in, j]
+                            col_count[j] += 1
+            # Horizontal running window over the column sums
+            window_sum = acc_zero
+            window_count = 0
+            for j in range(min(r, width)):
+                window_sum += col_sum[j]
+                window_count += col_count[j]
+            for j in range(width):
+                col_in = j + r
+                if col_in < width:
+                    window_sum += col_sum[col_in]
+                    window_count += col_count[col_in]
+                col_out = j - r - 1
+                if col_out >= 0:
+                    window_sum -= col_sum[col_out]
+                    window_count -= col_count[col_out]
+                if valid[i, j] and window_count > 0:
+                    out[i, j] = dem[i, j] - window_sum / window_count
+                else:
+                    out[i, j] = np.nan
 
-tpi = dem_array - mean_elevation_neighborhood # Original dem_array might have NaNs, so TPI will too
+# Nodata cells are skipped by the kernel (not filled with a mean), and TPI is NaN there
+if dem_nodata is None:
+    valid_dem = np.ones(dem_array.shape, dtype=bool)
+elif np.isnan(dem_nodata):
+    valid_dem = ~np.isnan(dem_array)
+else:
+    valid_dem = dem_array != dem_nodata
+# The int16 SRTM band is fed to the kernel as-is (half the bytes of float32) and summed in int64;
+# only the TPI itself is float32, since the 0.5 m threshold needs sub-metre resolution.
+tpi_acc_zero = np.int64(0) if np.issubdtype(dem_array.dtype, np.integer) else np.float64(0)
+tpi = np.empty(dem_array.shape, dtype=np.float32)
+tpi_kernel(dem_array, valid_dem, kernel_size, tpi_acc_zero, tpi)
 
 tpi_interfluve_threshold = 0.5  # EXAMPLE
 # Handle NaNs in TPI before comparison
@@ -314,17 +399,13 @@ interfluves_by_tpi = np.where(np.isnan(tpi), 0, (tpi > tpi_interfluve_threshold)
 
 tpi_path = os.path.join(output_dir, 'tpi_gee.tif')
 interfluves_tpi_path = os.path.join(output_dir, 'interfluves_by_tpi_gee.tif')
-tpi_profile = profile.copy()
-tpi_profile.update(dtype=rasterio.float32, compress='lzw')
-with rasterio.open(tpi_path, 'w', **tpi_profile) as dst:
-    dst.write(tpi.astype(rasterio.float32), 1) # Save TPI with potential NaNs
+tpi_profile = base_profile.copy()
+tpi_profile.update(dtype=rasterio.float32, nodata=np.float32(np.nan), **float32_creation_options)
+output_writes.append((tpi_path, tpi, tpi_profile)) # Save TPI with potential NaNs
 
-interfluve_tpi_profile = profile.copy()
-interfluve_tpi_profile.update(dtype=rasterio.uint8, compress='lzw')
-with rasterio.open(interfluves_tpi_path, 'w', **interfluve_tpi_profile) as dst:
-    dst.write(interfluves_by_tpi, 1)
-print(f"TPI saved to {tpi_path}")
-print(f"Interfluves by TPI saved to {interfluves_tpi_path}")
+interfluve_tpi_profile = base_profile.copy()
+interfluve_tpi_profile.update(dtype=rasterio.uint8, **uint8_creation_options)
+output_writes.append((interfluves_tpi_path, interfluves_by_tpi, interfluve_tpi_profile))
 
 
 # Method 3: Combine Distance and TPI
@@ -332,13 +413,43 @@ print("Combining distance and TPI methods for interfluves...")
 if interfluves_by_distance.shape == interfluves_by_tpi.shape:
     combined_interfluves = (interfluves_by_distance & interfluves_by_tpi).astype(np.uint8)
     combined_interfluves_path = os.path.join(output_dir, 'combined_interfluves_gee.tif')
-    with rasterio.open(streams_path) as src_meta_provider:
-        profile = src_meta_provider.profile.copy()
-        with rasterio.open(combined_interfluves_path, 'w', **profile) as dst:
-            dst.write(combined_interfluves, 1)
-    print(f"Combined interfluves saved to {combined_interfluves_path}")
+    output_writes.append((combined_interfluves_path, combined_interfluves, streams_profile))
+
+    # Vectorize the combined mask once, so consumers can query polygons instead of reloading mask rasters
+    print("Vectorizing combined interfluves...")
+    combined_interfluves_vector_path = os.path.join(output_dir, 'combined_interfluves_gee.fgb')
+    combined_polygons = [
+        shape(geom) for geom, value in shapes(combined_interfluves, mask=combined_interfluves.view(bool),
+                                              transform=base_profile['transform'])
+        if value == 1
+    ]
+    gpd.GeoDataFrame(geometry=combined_polygons, crs=base_profile['crs']).to_file(
+        combined_interfluves_vector_path, driver='FlatGeobuf', engine='pyogrio')
+    print(f"Combined interfluve polygons ({len(combined_polygons)}) saved to {combined_interfluves_vector_path}")
 else:
     print("Shapes of distance and TPI interfluve arrays do not match. Skipping combination.")
 
+
+# --- 5. Save outputs ---
+# The writes are independent and I/O bound (rasterio releases the GIL inside GDAL), so run them concurrently
+def write_raster(path, array, profile):
+    try:
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(array, 1)
+    except rasterio.errors.RasterioError as e: # e.g. GDAL built without ZSTD
+        print(f"Warning: writing {path} with {profile.get('compress')} failed ({e}), retrying with LZW.")
+        lzw_profile = profile.copy()
+        lzw_profile.pop('zstd_level', None)
+        lzw_profile.update(compress='lzw')
+        with rasterio.open(path, 'w', **lzw_profile) as dst:
+            dst.write(array, 1)
+    return path
+
+print(f"Writing {len(output_writes)} output rasters...")
+with ThreadPoolExecutor(max_workers=4) as executor:
+    write_futures = [executor.submit(write_raster, path, array, profile) for path, array, profile in output_writes]
+    for future in write_futures:
+        print(f"Saved {future.result()}") # result() re-raises any write error
+
 print("Processing complete. Check the output_data_gee directory.")
 
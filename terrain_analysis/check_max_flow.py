@@ -3,20 +3,40 @@ import numpy as np
 import os
 
 facc_path = "output_data/intermediate_outputs/facc_wbt.tif"
+max_sample_size = 1_000_000 # Median/percentiles use a strided sample of at most this many cells
 
 if os.path.exists(facc_path):
     with rasterio.open(facc_path) as src:
-        facc_data = src.read(1)
         nodata = src.nodatavals[0] if src.nodatavals else None
-        if nodata is not None:
-            facc_data = facc_data[facc_data != nodata] # Exclude nodata for min/max
-        if facc_data.size > 0:
-            print(f"Flow Accumulation Min: {np.min(facc_data)}")
-            print(f"Flow Accumulation Max: {np.max(facc_data)}")
-            print(f"Flow Accumulation Mean: {np.mean(facc_data)}")
-            print(f"Flow Accumulation Median: {np.median(facc_data)}")
-            print(f"Flow Accumulation 95th percentile: {np.percentile(facc_data, 95)}")
-            print(f"Flow Accumulation 99th percentile: {np.percentile(facc_data, 99)}")
+        sample_step = max(1, (src.width * src.height) // max_sample_size)
+        # Stream the raster block by block, keeping running statistics instead of the whole array
+        count = 0
+        total = 0.0
+        facc_min = np.inf
+        facc_max = -np.inf
+        samples = []
+        for _, window in src.block_windows(1):
+            block = src.read(1, window=window).ravel()
+            if nodata is not None:
+                block = block[block != nodata] # Exclude nodata for min/max
+            if block.size == 0:
+                continue
+            count += block.size
+            total += block.sum(dtype=np.float64)
+            facc_min = min(facc_min, block.min())
+            facc_max = max(facc_max, block.max())
+            samples.append(block[::sample_step])
+        if count > 0:
+            sample = np.concatenate(samples)
+            median, p95, p99 = np.percentile(sample, [50, 95, 99])
+            print(f"Flow Accumulation Min: {facc_min}")
+            print(f"Flow Accumulation Max: {facc_max}")
+            print(f"Flow Accumulation Mean: {total / count}")
+            if sample_step > 1:
+                print(f"(Median and percentiles estimated from {sample.size} of {count} valid cells)")
+            print(f"Flow Accumulation Median: {median}")
+            print(f"Flow Accumulation 95th percentile: {p95}")
+            print(f"Flow Accumulation 99th percentile: {p99}")
         else:
             print("No valid data in FACC raster after excluding nodata.")
 else:
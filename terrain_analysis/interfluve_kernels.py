@@ -0,0 +1,124 @@
+import numpy as np
+from scipy.ndimage import uniform_filter, maximum_filter1d
+from numba import njit, prange
+
+# Interfluve kernels and output options shared by strm_analysis.py (PySheds) and strm_analysis_new.py (WhiteboxTools);
+# strm_analysis_simple.py uses nodata_fill_and_weights. Python puts a script's own directory on sys.path, so they
+# import it as a sibling module.
+
+# GeoTIFF creation options for the outputs: tiled ZSTD decodes faster than LZW at a better ratio
+# (needs GDAL built with ZSTD). Predictor 2 suits the integer masks, predictor 3 the float32 TPI.
+uint8_creation_options = {'compress': 'zstd', 'zstd_level': 1, 'predictor': 2, 'tiled': True,
+                          'blockxsize': 512, 'blockysize': 512, 'num_threads': 'all_cpus'}
+float32_creation_options = {'compress': 'zstd', 'zstd_level': 1, 'predictor': 3, 'tiled': True,
+                            'blockxsize': 512, 'blockysize': 512, 'num_threads': 'all_cpus'}
+# The 0/1 interfluve masks are bitpacked on disk (NBITS=1, read back as uint8); GDAL has no
+# horizontal predictor for 1-bit samples, so it is disabled for them.
+mask_creation_options = {**uint8_creation_options, 'nbits': 1, 'predictor': 1}
+
+# --- Numba kernels ---
+@njit(parallel=True, fastmath=True, cache=True)
+def tpi_and_threshold(dem, mean_nb, nodata_mask, thr, tpi_out, mask_out):
+    """Fused TPI subtraction and threshold: one pass writes TPI (NaN on nodata) and the uint8 interfluve mask."""
+    for i in prange(dem.shape[0]):
+        for j in range(dem.shape[1]):
+            if nodata_mask[i, j]:
+                tpi_out[i, j] = np.nan
+                mask_out[i, j] = 0
+            else:
+                v = dem[i, j] - mean_nb[i, j]
+                tpi_out[i, j] = v
+                mask_out[i, j] = 1 if v > thr else 0
+
+@njit(parallel=True, boundscheck=False, cache=True)
+def and_u8(a, b, out):
+    """Bytewise AND of two C-contiguous uint8 masks into a preallocated out (vectorizes to packed ANDs)."""
+    a_flat = a.reshape(-1)
+    b_flat = b.reshape(-1)
+    out_flat = out.reshape(-1)
+    for i in prange(a_flat.size):
+        out_flat[i] = a_flat[i] & b_flat[i]
+
+@njit(parallel=True, cache=True)
+def nodata_fill_and_weights(dem, nodata, fill_val, filled_out, weights_out, mask_out):
+    """
+    One pass over the DEM: cells equal to nodata or NaN are flagged in mask_out, replaced by fill_val
+    in filled_out and given weight 0 (else 1) in weights_out. Pass nodata=NaN when there is no sentinel.
+    No fastmath here, since it would let LLVM assume the NaN test is always false.
+    """
+    for i in prange(dem.shape[0]):
+        for j in range(dem.shape[1]):
+            x = dem[i, j]
+            invalid = np.isnan(x) or x == nodata
+            mask_out[i, j] = invalid
+            filled_out[i, j] = fill_val if invalid else x
+            weights_out[i, j] = 0 if invalid else 1
+
+# --- Interfluve stages (plain functions around the cached kernels; I/O stays in the scripts) ---
+def disk_structure(radius):
+    """Bool (2r+1, 2r+1) footprint of the cells within Euclidean distance `radius` of the centre."""
+    dy, dx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    return dy * dy + dx * dx <= radius * radius
+
+def stage_distance(binary_streams, threshold_pixels, interior=(slice(None), slice(None))):
+    """
+    Returns a uint8 0/1 mask (`interior` only) of cells more than `threshold_pixels` (Euclidean, as in
+    strm_analysis_simple.py) from any stream cell (bool input).
+    Only "more than N pixels from any stream" is used, so the streams are dilated by a radius-N disk instead of
+    computing a float64 distance for every cell. Each disk row is a horizontal run: the streams are grown by each
+    distinct half-width with a running-max filter and OR-ed in at that row's offsets.
+    """
+    height = binary_streams.shape[0]
+    half_widths = disk_structure(threshold_pixels).sum(axis=1) // 2 # Run half-width per row offset -N..N
+    streams_u8 = binary_streams.view(np.uint8)
+    near_stream = np.zeros(binary_streams.shape, dtype=np.bool_)
+    for half_width in np.unique(half_widths):
+        grown = maximum_filter1d(streams_u8, size=2 * int(half_width) + 1, axis=1, mode='constant').view(np.bool_)
+        for dy in np.flatnonzero(half_widths == half_width) - threshold_pixels:
+            if abs(dy) >= height:
+                continue # Offset is past the raster (tiny rasters only)
+            if dy >= 0:
+                near_stream[dy:] |= grown[:height - dy]
+            else:
+                near_stream[:height + dy] |= grown[-dy:]
+    return (~near_stream[interior]).view(np.uint8) # bool and uint8 share the 0/1 byte layout, no copy
+
+def stage_tpi(dem_f32, nodata, kernel_size, thr, interior=None):
+    """
+    Returns (tpi, mask) for a float32 DEM (or the `interior` of a haloed tile): TPI is the DEM minus the NaN-aware
+    kernel_size box mean (NaN on nodata) and mask is the uint8 TPI > thr interfluve mask.
+    Pass nodata=NaN when there is no sentinel.
+    """
+    # Two DEM-sized float32 scratch buffers are reused instead of allocating a new array per step:
+    # a = zero-filled DEM -> neighborhood sum -> mean, b = neighborhood count -> TPI.
+    # scipy's 1D filter passes buffer each line, so filtering in place is safe.
+    # Elevations stay float32: float16 steps (0.06-0.25 m at Amazon elevations) are too coarse for the 0.5 m threshold,
+    # so bandwidth is saved on the 0/1 weights instead, which are uint8.
+    scratch_f32a = np.empty_like(dem_f32)
+    scratch_f32b = np.empty_like(dem_f32)
+    valid_weights = np.empty(dem_f32.shape, dtype=np.uint8)
+    nodata_mask = np.empty(dem_f32.shape, dtype=np.bool_)
+    # Single pass builds the nodata mask, the zero-filled DEM and the weights (no boolean-indexed copies)
+    nodata_fill_and_weights(dem_f32, np.float32(nodata), np.float32(0), scratch_f32a, valid_weights, nodata_mask)
+
+    # NaN-aware box mean as sum/count of valid cells: two separable uniform_filter passes in C
+    # instead of a Python callback per window. Nodata cells contribute neither sum nor count.
+    # scipy's 'mirror' (d c b | a b c d) is numpy's np.pad 'reflect', the edge handling of the original generic_filter.
+    neighborhood_sum = uniform_filter(scratch_f32a, size=kernel_size, mode='mirror', output=scratch_f32a)
+    if nodata_mask.any():
+        neighborhood_count = uniform_filter(valid_weights, size=kernel_size, mode='mirror', output=scratch_f32b)
+        np.maximum(neighborhood_count, 1e-6, out=neighborhood_count)
+        mean_elevation_neighborhood = np.divide(neighborhood_sum, neighborhood_count, out=scratch_f32a)
+    else:
+        mean_elevation_neighborhood = neighborhood_sum # Every window is fully valid, so the count is 1 everywhere
+
+    if interior is None:
+        tpi = scratch_f32b # The count is no longer needed once the mean is formed
+        mask = np.empty(dem_f32.shape, dtype=np.uint8)
+        tpi_and_threshold(dem_f32, mean_elevation_neighborhood, nodata_mask, thr, tpi, mask)
+    else:
+        tile_shape = mean_elevation_neighborhood[interior].shape
+        tpi = np.empty(tile_shape, dtype=np.float32)
+        mask = np.empty(tile_shape, dtype=np.uint8)
+        tpi_and_threshold(dem_f32[interior], mean_elevation_neighborhood[interior], nodata_mask[interior], thr, tpi, mask)
+    return tpi, mask
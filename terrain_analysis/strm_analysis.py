@@ -1,14 +1,56 @@
 import pysheds
 from pysheds.grid import Grid
+from pysheds.sview import Raster
 import numpy as np
 import rasterio
 import os
 import logging
+import contextlib
+import interfluve_kernels
+from interfluve_kernels import and_u8, uint8_creation_options, float32_creation_options, mask_creation_options
+try:
+    import richdem as rd # Optional: much faster depression filling on large DEMs
+except ImportError:
+    rd = None
+try:
+    import cupy as cp # Optional: GPU path for the interfluve stages on large DEMs
+    from cupyx.scipy.ndimage import uniform_filter as cp_uniform_filter, binary_dilation as cp_binary_dilation
+    gpu_available = cp.cuda.runtime.getDeviceCount() > 0
+except Exception: # ImportError, or CuPy installed without a usable CUDA device
+    gpu_available = False
+gpu_min_pixels = 4_000_000 # Below this, transfer overhead outweighs the GPU speedup
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# --- Interfluve stages (CPU versions shared with strm_analysis_new.py; I/O stays in the script body) ---
+def stage_distance(streams, threshold_pixels):
+    """Returns a uint8 0/1 mask of cells more than `threshold_pixels` (Euclidean) from any stream cell (streams > 0)."""
+    if gpu_available and streams.size >= gpu_min_pixels:
+        disk_gpu = cp.asarray(interfluve_kernels.disk_structure(threshold_pixels))
+        near_stream_gpu = cp_binary_dilation(cp.asarray(streams) > 0, structure=disk_gpu)
+        return cp.asnumpy(~near_stream_gpu).view(np.uint8)
+    return interfluve_kernels.stage_distance(streams > 0, threshold_pixels)
+
+def stage_tpi(dem_f32, nodata, kernel_size, thr):
+    """Returns (tpi, mask) for a float32 DEM; see interfluve_kernels.stage_tpi."""
+    if gpu_available and dem_f32.size >= gpu_min_pixels:
+        return stage_tpi_gpu(dem_f32, nodata, kernel_size, thr)
+    return interfluve_kernels.stage_tpi(dem_f32, nodata, kernel_size, thr)
+
+def stage_tpi_gpu(dem_f32, nodata, kernel_size, thr):
+    """CuPy version of stage_tpi (same sum/count box mean on the device); results are copied back to host."""
+    dem_gpu = cp.asarray(dem_f32)
+    nodata_mask = cp.isnan(dem_gpu) | (dem_gpu == np.float32(nodata))
+    neighborhood_sum = cp_uniform_filter(cp.where(nodata_mask, cp.float32(0), dem_gpu), size=kernel_size, mode='mirror')
+    neighborhood_count = cp_uniform_filter((~nodata_mask).astype(cp.float32), size=kernel_size, mode='mirror')
+    tpi_gpu = dem_gpu - neighborhood_sum / cp.maximum(neighborhood_count, 1e-6)
+    tpi_gpu[nodata_mask] = cp.nan
+    mask_gpu = (tpi_gpu > thr).astype(cp.uint8) # NaN compares False, so nodata stays 0
+    return cp.asnumpy(tpi_gpu), cp.asnumpy(mask_gpu)
+
+
 actual_dem_path_for_pysheds = "input_data/dem/gee_srtm_aoi.tif"
 # Define base output dirs for convenience
 output_interfluves_dir = "output_data/interfluves/"
@@ -50,16 +92,36 @@ if hasattr(dem_raster_view, 'dtype'):
 logger.info(f"Grid properties after read_raster & updates: Shape: {grid.shape}, Affine: {grid.affine}, Nodata: {grid.nodata}, CRS: {grid.crs}, Dtype: {grid.dtype}")
 
 logger.info("Filling depressions...")
-flooded_dem_raster_view = grid.fill_depressions(dem=dem_raster_view, out_name='flooded_dem')
+if rd is not None:
+    # richdem's priority-flood fill is several times faster than pysheds' on large DEMs. The filled array is
+    # wrapped back into a pysheds Raster on the same viewfinder, so flowdir sees the same grid and nodata.
+    logger.info("Using richdem for depression filling.")
+    # Filled on a copy: rdarray would otherwise share memory with dem_raster_view, which TPI still reads unfilled
+    dem_rd = rd.rdarray(np.array(dem_raster_view, copy=True), no_data=dem_raster_view.nodata)
+    rd.FillDepressions(dem_rd, epsilon=False, in_place=True)
+    flooded_dem_raster_view = Raster(np.asarray(dem_rd), viewfinder=dem_raster_view.viewfinder)
+else:
+    flooded_dem_raster_view = grid.fill_depressions(dem=dem_raster_view, out_name='flooded_dem')
 logger.info(f"Depressions filled. Returned type: {type(flooded_dem_raster_view)}")
 logger.debug(f"flooded_dem_raster_view.dtype: {flooded_dem_raster_view.dtype}, .nodata: {getattr(flooded_dem_raster_view, 'nodata', 'N/A')}")
 
+@contextlib.contextmanager
+def grid_ctx(grid, **attrs):
+    """Temporarily sets grid attributes (e.g. nodata, dtype) for one PySheds call and restores them afterwards."""
+    backup = {name: getattr(grid, name) for name in attrs}
+    logger.debug(f"Temporarily setting grid attributes: {attrs}")
+    try:
+        for name, value in attrs.items():
+            setattr(grid, name, value)
+        yield grid
+    finally:
+        for name, value in backup.items():
+            setattr(grid, name, value)
+        logger.debug(f"Restored grid attributes: {backup}")
+
 logger.info("Calculating flow direction...")
 fdir_raster_view = None
 if flooded_dem_raster_view is not None:
-    grid_nodata_backup_fdir = grid.nodata
-    grid_dtype_backup_fdir = grid.dtype
-    
     # PySheds sGrid seems to make fdir output int64. Let's align with that.
     # The nodata for fdir (0) should also be int64 to match fdir_raster_view.dtype.
     flowdir_output_nodata_typed = np.int64(0)
@@ -68,22 +130,17 @@ if flooded_dem_raster_view is not None:
     # Let's assume sGrid will make fdir int64, so make grid context compatible.
     flowdir_internal_dtype = np.int64 # Based on previous log output for fdir_raster_view.dtype
     
-    logger.debug(f"Temporarily setting grid.nodata to {flowdir_output_nodata_typed} (type {type(flowdir_output_nodata_typed)}) and grid.dtype to {flowdir_internal_dtype} for flowdir.")
-    grid.nodata = flowdir_output_nodata_typed
-    grid.dtype = flowdir_internal_dtype # Make grid context match expected fdir output
-    try:
-        # Pass nodata_out as the same type as grid.nodata (which is now int64(0))
-        fdir_raster_view = grid.flowdir(dem=flooded_dem_raster_view, out_name='fdir', nodata_out=flowdir_output_nodata_typed)
-        logger.info(f"Flow direction calculated. Returned type: {type(fdir_raster_view)}")
-        logger.debug(f"fdir_raster_view.dtype: {fdir_raster_view.dtype}, .nodata: {getattr(fdir_raster_view, 'nodata', 'N/A')}")
-        # We expect fdir_raster_view.dtype to be int64 and .nodata to be int64(0)
-    except Exception as e:
-        logger.error(f"Error during grid.flowdir: {e}", exc_info=True)
-        raise
-    finally:
-        grid.nodata = grid_nodata_backup_fdir
-        grid.dtype = grid_dtype_backup_fdir
-        logger.debug(f"Restored grid.nodata to: {grid.nodata} (type: {type(grid.nodata)}), grid.dtype to: {grid.dtype}")
+    # Make grid context match expected fdir output
+    with grid_ctx(grid, nodata=flowdir_output_nodata_typed, dtype=flowdir_internal_dtype):
+        try:
+            # Pass nodata_out as the same type as grid.nodata (which is now int64(0))
+            fdir_raster_view = grid.flowdir(dem=flooded_dem_raster_view, out_name='fdir', nodata_out=flowdir_output_nodata_typed)
+            logger.info(f"Flow direction calculated. Returned type: {type(fdir_raster_view)}")
+            logger.debug(f"fdir_raster_view.dtype: {fdir_raster_view.dtype}, .nodata: {getattr(fdir_raster_view, 'nodata', 'N/A')}")
+            # We expect fdir_raster_view.dtype to be int64 and .nodata to be int64(0)
+        except Exception as e:
+            logger.error(f"Error during grid.flowdir: {e}", exc_info=True)
+            raise
 else:
     logger.warning("Skipping flow direction as flooded_dem_raster_view is None.")
     exit("Flow direction failed.")
@@ -118,49 +175,42 @@ else:
 logger.info("Extracting stream network with threshold: 1000...")
 streams_raster_view = None
 if acc_raster_view is not None:
-    grid_nodata_backup_streams = grid.nodata
-    grid_dtype_backup_streams = grid.dtype
     streams_output_nodata_typed = np.uint8(0)
+    streams_output_nodata_val = int(streams_output_nodata_typed)
     streams_output_dtype = np.uint8
 
-    logger.debug(f"Temporarily setting grid.nodata to {streams_output_nodata_typed} and grid.dtype to {streams_output_dtype} for streams.")
-    grid.nodata = streams_output_nodata_typed
-    grid.dtype = streams_output_dtype
-    try:
-        # extract_river_network uses fdir_raster_view and acc_raster_view.
-        # Its output sview.Raster is created using the main grid's current viewfinder (nodata/dtype).
-        grid.extract_river_network(fdir=fdir_raster_view, acc=acc_raster_view, threshold=1000, out_name='streams')
-        logger.info(f"Stream network extracted.")
-        streams_raster_view = grid.get_data('streams', return_sview=True)
-        logger.info(f"Accessed 'streams' via grid.get_data(), type: {type(streams_raster_view)}")
-        logger.debug(f"streams_raster_view.dtype: {streams_raster_view.dtype}, .nodata: {getattr(streams_raster_view, 'nodata', 'N/A')}")
-
-        if streams_raster_view is not None:
-            streams_path = "output_data/interfluves/streams_gee.tif"
-            profile = {
-                'driver': 'GTiff', 'dtype': rasterio.uint8, 'nodata': streams_output_nodata_typed.item(),
-                'width': grid.shape[1], 'height': grid.shape[0], 'count': 1,
-                'crs': grid.crs, 'transform': grid.affine, 'compress': 'lzw'
-            }
-            if hasattr(streams_raster_view, 'filled'):
-                data_to_save = streams_raster_view.filled(streams_output_nodata_typed.item()).astype(np.uint8)
-            elif isinstance(streams_raster_view, np.ndarray):
-                data_to_save = streams_raster_view.astype(np.uint8)
-            else:
-                logger.error(f"Could not convert streams_raster_view to a savable NumPy array.")
-                data_to_save = None
-
-            if data_to_save is not None:
-                with rasterio.open(streams_path, 'w', **profile) as dst:
-                    dst.write(data_to_save, 1)
-                logger.info(f"Streams raster saved to {streams_path}")
-    except Exception as e:
-        logger.error(f"Error obtaining or saving 'streams' data: {e}", exc_info=True)
-        raise
-    finally:
-        grid.nodata = grid_nodata_backup_streams
-        grid.dtype = grid_dtype_backup_streams
-        logger.debug(f"Restored grid.nodata to: {grid.nodata}, grid.dtype to: {grid.dtype}")
+    with grid_ctx(grid, nodata=streams_output_nodata_typed, dtype=streams_output_dtype):
+        try:
+            # extract_river_network uses fdir_raster_view and acc_raster_view.
+            # Its output sview.Raster is created using the main grid's current viewfinder (nodata/dtype).
+            grid.extract_river_network(fdir=fdir_raster_view, acc=acc_raster_view, threshold=1000, out_name='streams')
+            logger.info(f"Stream network extracted.")
+            streams_raster_view = grid.get_data('streams', return_sview=True)
+            logger.info(f"Accessed 'streams' via grid.get_data(), type: {type(streams_raster_view)}")
+            logger.debug(f"streams_raster_view.dtype: {streams_raster_view.dtype}, .nodata: {getattr(streams_raster_view, 'nodata', 'N/A')}")
+
+            if streams_raster_view is not None:
+                streams_path = "output_data/interfluves/streams_gee.tif"
+                profile = {
+                    'driver': 'GTiff', 'dtype': rasterio.uint8, 'nodata': streams_output_nodata_val,
+                    'width': grid.shape[1], 'height': grid.shape[0], 'count': 1,
+                    'crs': grid.crs, 'transform': grid.affine, **uint8_creation_options
+                }
+                if hasattr(streams_raster_view, 'filled'):
+                    data_to_save = streams_raster_view.filled(streams_output_nodata_val).astype(np.uint8)
+                elif isinstance(streams_raster_view, np.ndarray):
+                    data_to_save = streams_raster_view.astype(np.uint8)
+                else:
+                    logger.error(f"Could not convert streams_raster_view to a savable NumPy array.")
+                    data_to_save = None
+
+                if data_to_save is not None:
+                    with rasterio.open(streams_path, 'w', **profile) as dst:
+                        dst.write(data_to_save, 1)
+                    logger.info(f"Streams raster saved to {streams_path}")
+        except Exception as e:
+            logger.error(f"Error obtaining or saving 'streams' data: {e}", exc_info=True)
+            raise
 else:
     logger.warning("Skipping stream extraction as acc_raster_view was not obtained or is None.")
     exit("Stream extraction failed.")
@@ -184,16 +234,14 @@ else:
 # --- 4. Identify Interfluve Zones ---
 # (Copied from your original script, assuming streams_numpy_array is correctly populated)
 logger.info("Calculating distance from streams...")
-binary_streams = (streams_numpy_array > 0).astype(np.uint8)
-distance_to_streams = distance_transform_edt(1 - binary_streams)
 distance_interfluve_threshold_pixels = 15
-interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
+interfluves_by_distance = stage_distance(streams_numpy_array, distance_interfluve_threshold_pixels)
 
 interfluves_dist_path = "output_data/interfluves/interfluves_by_distance_gee.tif"
 profile_uint8_nodata0 = { # Define a suitable profile for these binary outputs
     'driver': 'GTiff', 'dtype': rasterio.uint8, 'nodata': 0,
     'width': grid.shape[1], 'height': grid.shape[0], 'count': 1,
-    'crs': grid.crs, 'transform': grid.affine, 'compress': 'lzw'
+    'crs': grid.crs, 'transform': grid.affine, **mask_creation_options
 }
 with rasterio.open(interfluves_dist_path, 'w', **profile_uint8_nodata0) as dst:
     dst.write(interfluves_by_distance, 1)
@@ -201,8 +249,10 @@ logger.info(f"Interfluves by distance saved to {interfluves_dist_path}")
 
 
 logger.info("Calculating TPI...")
+# Ensure grid.nodata.item() is used if grid.nodata is a numpy scalar
+dem_nodata_val_for_tpi = grid.nodata.item() if hasattr(grid.nodata, 'item') else grid.nodata
 if hasattr(dem_raster_view, 'filled'):
-    dem_numpy_array_for_tpi = dem_raster_view.filled(grid.nodata.item()).astype(np.float32)
+    dem_numpy_array_for_tpi = dem_raster_view.filled(dem_nodata_val_for_tpi).astype(np.float32)
 elif isinstance(dem_raster_view, np.ndarray):
     dem_numpy_array_for_tpi = dem_raster_view.astype(np.float32)
 else:
@@ -211,29 +261,12 @@ else:
 
 tpi_profile_base = {
     'driver': 'GTiff', 'width': grid.shape[1], 'height': grid.shape[0],
-    'count': 1, 'crs': grid.crs, 'transform': grid.affine, 'compress': 'lzw'
+    'count': 1, 'crs': grid.crs, 'transform': grid.affine, **float32_creation_options
 }
 kernel_size = 9
-pad_width = kernel_size // 2
-# Ensure grid.nodata.item() is used if grid.nodata is a numpy scalar
-dem_nodata_val_for_tpi = grid.nodata.item() if hasattr(grid.nodata, 'item') else grid.nodata
-dem_array_no_nan = np.nan_to_num(dem_numpy_array_for_tpi, nan=np.nanmean(dem_numpy_array_for_tpi[dem_numpy_array_for_tpi != dem_nodata_val_for_tpi]))
-
-dem_padded = np.pad(dem_array_no_nan, pad_width, mode='reflect')
-
-def mean_filter_nan_aware(arr):
-    valid_arr = arr[~np.isnan(arr)]
-    if valid_arr.size == 0: return np.nan
-    return np.mean(valid_arr)
-
-mean_elevation_neighborhood = generic_filter(
-    dem_padded, mean_filter_nan_aware, size=kernel_size, mode='constant', cval=np.nan
-)
-mean_elevation_neighborhood = mean_elevation_neighborhood[pad_width:-pad_width, pad_width:-pad_width]
-
-tpi = dem_numpy_array_for_tpi - mean_elevation_neighborhood
+dem_nodata_for_kernel = np.float32(np.nan if dem_nodata_val_for_tpi is None else dem_nodata_val_for_tpi)
 tpi_interfluve_threshold = 0.5
-interfluves_by_tpi = np.where(np.isnan(tpi), 0, (tpi > tpi_interfluve_threshold)).astype(np.uint8)
+tpi, interfluves_by_tpi = stage_tpi(dem_numpy_array_for_tpi, dem_nodata_for_kernel, kernel_size, tpi_interfluve_threshold)
 
 tpi_path = "output_data/intermediate_outputs/tpi_gee.tif" # TPI is an intermediate product
 interfluves_tpi_path = "output_data/interfluves/interfluves_by_tpi_gee.tif"
@@ -241,7 +274,7 @@ interfluves_tpi_path = "output_data/interfluves/interfluves_by_tpi_gee.tif"
 tpi_profile_out = tpi_profile_base.copy()
 tpi_profile_out.update(dtype=rasterio.float32, nodata=np.float32(np.nan))
 with rasterio.open(tpi_path, 'w', **tpi_profile_out) as dst:
-    dst.write(tpi.astype(rasterio.float32), 1)
+    dst.write(tpi, 1)
 
 interfluve_tpi_profile_out = profile_uint8_nodata0.copy() # Use the uint8 profile
 with rasterio.open(interfluves_tpi_path, 'w', **interfluve_tpi_profile_out) as dst:
@@ -256,7 +289,9 @@ logger.info(f"Interfluves by TPI saved to {interfluves_tpi_path}")
 
 logger.info("Combining distance and TPI methods for interfluves...")
 if interfluves_by_distance.shape == interfluves_by_tpi.shape:
-    combined_interfluves = (interfluves_by_distance & interfluves_by_tpi).astype(np.uint8)
+    # The distance mask is already on disk, so AND into its buffer instead of allocating a third mask
+    combined_interfluves = interfluves_by_distance
+    and_u8(interfluves_by_distance, interfluves_by_tpi, combined_interfluves)
     combined_interfluves_path = "output_data/interfluves/combined_interfluves_gee.tif"
     with rasterio.open(combined_interfluves_path, 'w', **profile_uint8_nodata0) as dst: # Use uint8 profile
         dst.write(combined_interfluves, 1)
@@ -1,10 +1,16 @@
 import numpy as np
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-from scipy.ndimage import generic_filter, distance_transform_edt
+from rasterio.windows import Window
 import os
+import shutil
+import tempfile
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import whitebox
+from interfluve_kernels import (and_u8, stage_distance, stage_tpi,
+                                uint8_creation_options, float32_creation_options, mask_creation_options)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,7 +18,7 @@ logger.setLevel(logging.DEBUG)
 
 try:
     wbt = whitebox.WhiteboxTools()
-    wbt.verbose = True # Keep True for now
+    wbt.verbose = False # Per-step progress output slows the tools down; errors are still raised
     logger.info(f"WhiteboxTools initialized. Version: {wbt.version()}")
 except Exception as e:
     logger.error(f"Failed to initialize WhiteboxTools: {e}", exc_info=True)
@@ -26,6 +32,14 @@ output_interfluves_dir = "output_data/interfluves/"
 os.makedirs(output_processed_dem_dir, exist_ok=True)
 os.makedirs(output_intermediate_dir, exist_ok=True)
 os.makedirs(output_interfluves_dir, exist_ok=True)
+# Raw streams are only read by the next WBT step, so keep them on tmpfs (RAM) when available.
+# WBT runs as a separate process, so GDAL's /vsimem/ is not visible to it. The D8 pointer and flow
+# accumulation stay on disk: visualize_rasters.py and check_max_flow.py read them.
+# A fresh directory per run, so concurrent runs don't share or delete each other's files. The script leaves
+# through exit() on every error path, so an atexit hook acts as the try/finally that removes it; this
+# also frees the tmpfs when a run fails.
+wbt_scratch_dir = tempfile.mkdtemp(prefix="amazon_ai_wbt_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+atexit.register(shutil.rmtree, wbt_scratch_dir, ignore_errors=True)
 
 if not os.path.exists(actual_dem_path_abs):
     logger.critical(f"CRITICAL: Input DEM file not found at {actual_dem_path_abs}.")
@@ -54,7 +68,7 @@ wbt_compatible_dem_path_abs = "output_data/processed_dem/gee_srtm_aoi_wbt_compat
 filled_dem_path_abs = "output_data/processed_dem/filled_dem_wbt.tif"
 d8_pointer_path_abs = "output_data/intermediate_outputs/d8_pointer_wbt.tif"
 facc_path_abs = "output_data/intermediate_outputs/facc_wbt.tif"
-streams_wbt_path_abs = "output_data/intermediate_outputs/streams_raw_wbt.tif"
+streams_wbt_path_abs = os.path.join(wbt_scratch_dir, "streams_raw_wbt.tif")
 final_streams_path_abs = "output_data/interfluves/streams_gee_wbt_final.tif"
 interfluves_dist_path_abs = "output_data/interfluves/interfluves_by_distance_gee_wbt.tif"
 tpi_path_abs = "output_data/intermediate_outputs/tpi_gee_wbt.tif"
@@ -67,6 +81,7 @@ dem_width = None
 dem_height = None
 dem_crs = None # Store CRS for TPI output profile
 dem_transform = None # Store transform for TPI output profile
+initial_predictor = None
 
 try:
     with rasterio.open(actual_dem_path_abs) as src:
@@ -76,48 +91,70 @@ try:
         dem_height = src.height
         dem_crs = src.crs
         dem_transform = src.transform
+        initial_predictor = src.tags(ns='IMAGE_STRUCTURE').get('PREDICTOR')
         logger.info(f"Initial DEM properties: dtype={src.dtypes[0]}, nodata={initial_nodata_value}, W={dem_width}, H={dem_height}")
 except Exception as e:
     logger.error(f"Failed to read initial DEM properties from {actual_dem_path_abs}: {e}", exc_info=True)
     exit()
 
 # --- Pre-process input DEM for WhiteboxTools compatibility ---
-logger.info(f"Preparing WBT-compatible DEM from {actual_dem_path_abs} to {wbt_compatible_dem_path_abs}")
+# A single-band GTiff that is uncompressed or LZW/DEFLATE without a predictor is what the rewrite below
+# would produce anyway, so the compat path is linked to the input DEM and the full read + compressed write is
+# skipped. The compat path is kept because other scripts read it.
 dem_input_for_wbt = "" # Initialize
-try:
-    with rasterio.open(actual_dem_path_abs) as src:
-        data = src.read(1)
-        profile_for_wbt_dem = src.profile.copy()
+input_dem_wbt_compatible = (
+    initial_profile.get('driver') == 'GTiff'
+    and initial_profile.get('count') == 1
+    and str(initial_profile.get('compress') or 'none').lower() in ('none', 'lzw', 'deflate')
+    and initial_predictor in (None, '1')
+)
+if input_dem_wbt_compatible:
+    try:
+        if os.path.lexists(wbt_compatible_dem_path_abs):
+            os.remove(wbt_compatible_dem_path_abs)
+        try:
+            os.symlink(os.path.abspath(actual_dem_path_abs), wbt_compatible_dem_path_abs)
+        except OSError:
+            os.link(actual_dem_path_abs, wbt_compatible_dem_path_abs) # e.g. no symlink permission
+        logger.info(f"Input DEM {actual_dem_path_abs} is already WBT-compatible; linked it to {wbt_compatible_dem_path_abs}")
+        dem_input_for_wbt = wbt_compatible_dem_path_abs
+    except OSError as e:
+        logger.warning(f"Could not link {wbt_compatible_dem_path_abs} to the input DEM ({e}); rewriting it instead.")
+        input_dem_wbt_compatible = False
+if not input_dem_wbt_compatible:
+    logger.info(f"Preparing WBT-compatible DEM from {actual_dem_path_abs} to {wbt_compatible_dem_path_abs}")
+    try:
+        with rasterio.open(actual_dem_path_abs) as src:
+            data = src.read(1)
+            profile_for_wbt_dem = src.profile.copy()
         
-        # Set LZW compression for WBT compatibility
-        profile_for_wbt_dem['compress'] = 'lzw'
+            # Set LZW compression for WBT compatibility
+            profile_for_wbt_dem['compress'] = 'lzw'
         
-        # Ensure other essential tags are consistent
-        profile_for_wbt_dem.update({
-            'driver': 'GTiff',
-            'dtype': src.dtypes[0],
-            'nodata': initial_nodata_value,
-            'width': dem_width,
-            'height': dem_height,
-            'count': 1,
-            'crs': dem_crs,
-            'transform': dem_transform
-        })
-        # Remove potentially problematic tags if they exist from original profile
-        profile_for_wbt_dem.pop('photometric', None) 
-        profile_for_wbt_dem.pop('predictor', None) # Predictor might interact with LZW in ways WBT doesn't like for some data types
+            # Ensure other essential tags are consistent
+            profile_for_wbt_dem.update({
+                'driver': 'GTiff',
+                'dtype': src.dtypes[0],
+                'nodata': initial_nodata_value,
+                'width': dem_width,
+                'height': dem_height,
+                'count': 1,
+                'crs': dem_crs,
+                'transform': dem_transform
+            })
+            # Remove potentially problematic tags if they exist from original profile
+            profile_for_wbt_dem.pop('photometric', None) 
+            profile_for_wbt_dem.pop('predictor', None) # Predictor might interact with LZW in ways WBT doesn't like for some data types
 
-        with rasterio.open(wbt_compatible_dem_path_abs, 'w', **profile_for_wbt_dem) as dst:
-            dst.write(data, 1)
-    logger.info(f"WBT-compatible DEM saved to {wbt_compatible_dem_path_abs} with {profile_for_wbt_dem.get('compress', 'no')} compression.")
-    dem_input_for_wbt = wbt_compatible_dem_path_abs
-except Exception as e:
-    logger.error(f"Failed to create WBT-compatible DEM: {e}", exc_info=True)
-    exit()
+            with rasterio.open(wbt_compatible_dem_path_abs, 'w', **profile_for_wbt_dem) as dst:
+                dst.write(data, 1)
+        logger.info(f"WBT-compatible DEM saved to {wbt_compatible_dem_path_abs} with {profile_for_wbt_dem.get('compress', 'no')} compression.")
+        dem_input_for_wbt = wbt_compatible_dem_path_abs
+    except Exception as e:
+        logger.error(f"Failed to create WBT-compatible DEM: {e}", exc_info=True)
+        exit()
 
 # --- 1. Fill Depressions ---
-# Ensure dem_input_for_wbt is wbt_compatible_dem_path_abs if the pre-processing step was successful
-dem_input_for_wbt = wbt_compatible_dem_path_abs
 logger.info(f"Filling depressions with WhiteboxTools using: {dem_input_for_wbt}")
 try:
     wbt.fill_depressions(
@@ -130,155 +167,167 @@ except Exception as e:
     logger.error(f"Error during WhiteboxTools FillDepressions: {e}", exc_info=True)
     exit()
 
-# --- 2. Calculate D8 Flow Pointers ---
-logger.info("Calculating D8 flow pointers with WhiteboxTools...")
-try:
-    wbt.d8_pointer(
-        dem=filled_dem_path_abs,
-        output=d8_pointer_path_abs
-    )
-    logger.info(f"D8 flow pointers calculated. Output: {d8_pointer_path_abs}")
-except Exception as e:
-    logger.error(f"Error during WhiteboxTools D8Pointer: {e}", exc_info=True)
-    exit()
+def run_wbt_stream_stages():
+    """
+    Steps 2-4 (D8 pointer -> flow accumulation -> stream extraction). Each WBT tool runs as its own subprocess,
+    so this is submitted to a worker thread while the main thread computes TPI from the filled DEM.
+    Errors are logged and re-raised; the caller exits when it collects the result.
+    """
+    # --- 2. Calculate D8 Flow Pointers ---
+    logger.info("Calculating D8 flow pointers with WhiteboxTools...")
+    try:
+        wbt.d8_pointer(
+            dem=filled_dem_path_abs,
+            output=d8_pointer_path_abs
+        )
+        logger.info(f"D8 flow pointers calculated. Output: {d8_pointer_path_abs}")
+    except Exception as e:
+        logger.error(f"Error during WhiteboxTools D8Pointer: {e}", exc_info=True)
+        raise
 
-# --- 3. Calculate D8 Flow Accumulation ---
-logger.info("Calculating D8 flow accumulation with WhiteboxTools...")
-try:
-    wbt.d8_flow_accumulation(
-        i=d8_pointer_path_abs,
-        output=facc_path_abs,
-        out_type="cells"
-    )
-    logger.info(f"D8 flow accumulation calculated. Output: {facc_path_abs}")
-except Exception as e:
-    logger.error(f"Error during WhiteboxTools D8FlowAccumulation: {e}", exc_info=True)
-    exit()
+    # --- 3. Calculate D8 Flow Accumulation ---
+    logger.info("Calculating D8 flow accumulation with WhiteboxTools...")
+    try:
+        wbt.d8_flow_accumulation(
+            i=d8_pointer_path_abs,
+            output=facc_path_abs,
+            out_type="cells"
+        )
+        logger.info(f"D8 flow accumulation calculated. Output: {facc_path_abs}")
+    except Exception as e:
+        logger.error(f"Error during WhiteboxTools D8FlowAccumulation: {e}", exc_info=True)
+        raise
 
-# --- 4. Extract Stream Network ---
-logger.info("Extracting stream network with WhiteboxTools...")
-stream_threshold = 3
-try:
-    wbt.extract_streams(
-        facc_path_abs,
-        streams_wbt_path_abs,
-        threshold=stream_threshold,
-        zero_background=True
-    )
-    logger.info(f"Stream network extracted. Raw output: {streams_wbt_path_abs}")
-except Exception as e:
-    logger.error(f"Error during WhiteboxTools ExtractStreams: {e}", exc_info=True)
-    exit()
+    # --- 4. Extract Stream Network ---
+    logger.info("Extracting stream network with WhiteboxTools...")
+    stream_threshold = 3
+    try:
+        wbt.extract_streams(
+            facc_path_abs,
+            streams_wbt_path_abs,
+            threshold=stream_threshold,
+            zero_background=True
+        )
+        logger.info(f"Stream network extracted. Raw output: {streams_wbt_path_abs}")
+    except Exception as e:
+        logger.error(f"Error during WhiteboxTools ExtractStreams: {e}", exc_info=True)
+        raise
+
+# Outputs from here on are tiled and written block by block, so only one tile (plus halo) is held in RAM.
+# They use the shared ZSTD creation options; the WBT input DEM above stays LZW for WhiteboxTools.
 
-# --- 5. Load Streams into NumPy array and Save with consistent metadata ---
-streams_numpy_array = None
 # Use the initial_profile as a base for streams_profile, then update
 streams_profile = initial_profile.copy() 
 intended_streams_nodata_val = 0
+streams_profile.update({
+    'dtype': rasterio.uint8,
+    'nodata': intended_streams_nodata_val,
+    'count': 1,
+    **uint8_creation_options
+})
 
-if os.path.exists(streams_wbt_path_abs):
-    try:
-        with rasterio.open(streams_wbt_path_abs) as src:
-            streams_numpy_array = src.read(1).astype(np.uint8)
-            if streams_numpy_array.shape != (dem_height, dem_width):
-                 logger.warning(f"Stream raster shape {streams_numpy_array.shape} differs from DEM ({dem_height}, {dem_width}). This might be an issue.")
-
-            streams_profile.update({
-                'dtype': rasterio.uint8,
-                'nodata': intended_streams_nodata_val,
-                'compress': 'lzw',
-                'count': 1
-            })
-        logger.info(f"Streams raster loaded from {streams_wbt_path_abs} into NumPy array. Shape: {streams_numpy_array.shape}")
-        
-        with rasterio.open(final_streams_path_abs, 'w', **streams_profile) as dst:
-            dst.write(streams_numpy_array, 1)
-        logger.info(f"Processed streams raster saved to {final_streams_path_abs}")
+# --- Interfluve Analysis ---
+def padded_window(window, halo, height, width):
+    """
+    Expands a block window by `halo` pixels on every side, clipped to the raster extent.
+    Returns the window to read and the (row, col) slices of the original block inside it.
+    """
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    row_start = max(row_off - halo, 0)
+    col_start = max(col_off - halo, 0)
+    row_stop = min(row_off + int(window.height) + halo, height)
+    col_stop = min(col_off + int(window.width) + halo, width)
+    read_window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    interior = (slice(row_off - row_start, row_off - row_start + int(window.height)),
+                slice(col_off - col_start, col_off - col_start + int(window.width)))
+    return read_window, interior
 
-    except Exception as e:
-        logger.error(f"Failed to load or save processed streams raster from {streams_wbt_path_abs}: {e}", exc_info=True)
-        exit()
-else:
-    logger.error(f"WhiteboxTools stream output not found: {streams_wbt_path_abs}")
+if not os.path.exists(filled_dem_path_abs):
+    logger.error(f"Filled DEM file not found: {filled_dem_path_abs}. Cannot calculate TPI.")
     exit()
 
-# --- Interfluve Analysis ---
-if streams_numpy_array is not None:
-    logger.info("Starting Interfluve Analysis...")
-    logger.info("Calculating distance from streams...")
-    distance_to_streams = distance_transform_edt(1 - streams_numpy_array)
-    distance_interfluve_threshold_pixels = 15
-    interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
+kernel_size = 9
+pad_width = kernel_size // 2
+distance_interfluve_threshold_pixels = 15
+tpi_interfluve_threshold = 0.5
+# Each tile is read with a halo wide enough for its step (TPI window or stream-distance dilation),
+# so the interior of every tile matches a whole-raster computation exactly.
 
-    # Use streams_profile as base for uint8 outputs if suitable
-    profile_uint8_nodata0 = streams_profile.copy() 
+# Use streams_profile as base for uint8 outputs if suitable
+profile_uint8_nodata0 = streams_profile.copy() 
+profile_uint8_nodata0.update(mask_creation_options) # Bitpacked 0/1 masks
+# Use initial_profile as base for TPI output, then update for float32/NaN nodata
+tpi_profile_out = initial_profile.copy() 
+tpi_profile_out.update(dtype=rasterio.float32, nodata=np.float32(np.nan), count=1, **float32_creation_options)
 
-    with rasterio.open(interfluves_dist_path_abs, 'w', **profile_uint8_nodata0) as dst:
-        dst.write(interfluves_by_distance, 1)
-    logger.info(f"Interfluves by distance saved to {interfluves_dist_path_abs}")
+# TPI only needs the filled DEM, so it is computed while WBT derives the streams in the background.
+with ThreadPoolExecutor(max_workers=1) as executor:
+    wbt_streams_future = executor.submit(run_wbt_stream_stages)
 
-    logger.info("Calculating TPI using the filled DEM...")
-    dem_for_tpi_np = None
-    if os.path.exists(filled_dem_path_abs):
-        try:
-            with rasterio.open(filled_dem_path_abs) as src:
-                dem_for_tpi_np = src.read(1).astype(np.float32)
-                tpi_input_dem_nodata = src.nodatavals[0] if src.nodatavals else None
-                
-                logger.info(f"Filled DEM for TPI loaded from {filled_dem_path_abs}. Original dtype: {src.dtypes[0]}, nodata: {tpi_input_dem_nodata}. Converted to float32.")
-                if tpi_input_dem_nodata is not None:
-                    dem_for_tpi_np[dem_for_tpi_np == tpi_input_dem_nodata] = np.nan
-                
-        except Exception as e:
-            logger.error(f"Failed to load filled DEM for TPI from {filled_dem_path_abs}: {e}", exc_info=True)
-            exit()
-    else:
-        logger.error(f"Filled DEM file not found: {filled_dem_path_abs}. Cannot calculate TPI.")
+    logger.info("Calculating TPI tile by tile while WhiteboxTools extracts the stream network...")
+    try:
+        with rasterio.open(filled_dem_path_abs) as dem_src, \
+             rasterio.open(tpi_path_abs, 'w', **tpi_profile_out) as tpi_dst, \
+             rasterio.open(interfluves_tpi_path_abs, 'w', **profile_uint8_nodata0) as tpi_mask_dst:
+            tpi_input_dem_nodata = dem_src.nodatavals[0] if dem_src.nodatavals else None
+            tpi_kernel_nodata = np.float32(np.nan if tpi_input_dem_nodata is None else tpi_input_dem_nodata)
+            logger.info(f"Filled DEM for TPI: {filled_dem_path_abs}. Original dtype: {dem_src.dtypes[0]}, nodata: {tpi_input_dem_nodata}. Tiles are converted to float32.")
+
+            for _, window in tpi_dst.block_windows(1):
+                read_window, interior = padded_window(window, pad_width, dem_height, dem_width)
+                dem_for_tpi_np = dem_src.read(1, window=read_window, out_dtype=np.float32)
+                tpi, interfluves_by_tpi = stage_tpi(dem_for_tpi_np, tpi_kernel_nodata, kernel_size, tpi_interfluve_threshold, interior)
+                tpi_dst.write(tpi, 1, window=window)
+                tpi_mask_dst.write(interfluves_by_tpi, 1, window=window)
+    except Exception as e:
+        logger.error(f"Failed during tiled TPI calculation: {e}", exc_info=True)
         exit()
+    logger.info(f"TPI raster saved to {tpi_path_abs}")
+    logger.info(f"Interfluves by TPI saved to {interfluves_tpi_path_abs}")
 
-    if dem_for_tpi_np is not None:
-        kernel_size = 9
-        pad_width = kernel_size // 2
-        
-        dem_mask_for_tpi = np.isnan(dem_for_tpi_np)
-        
-        dem_mean_for_nan_replacement = np.nanmean(dem_for_tpi_np[~dem_mask_for_tpi]) if not np.all(dem_mask_for_tpi) else 0
-        dem_array_no_nodata = np.where(dem_mask_for_tpi, dem_mean_for_nan_replacement, dem_for_tpi_np)
-        
-        dem_padded = np.pad(dem_array_no_nodata, pad_width, mode='reflect')
+    try:
+        wbt_streams_future.result()
+    except Exception:
+        exit() # Already logged by run_wbt_stream_stages
 
-        mean_elevation_neighborhood = generic_filter(
-            dem_padded, np.mean, size=kernel_size, mode='reflect'
-        )
-        mean_elevation_neighborhood = mean_elevation_neighborhood[pad_width:-pad_width, pad_width:-pad_width]
+# --- 5. Save Streams with consistent metadata, distance interfluves and combination ---
+# The uint8 streams raster is written tile by tile from the same tiles the distance step reads,
+# so the raw WBT streams are read and converted only once.
+if not os.path.exists(streams_wbt_path_abs):
+    logger.error(f"WhiteboxTools stream output not found: {streams_wbt_path_abs}")
+    exit()
 
-        tpi = dem_for_tpi_np - mean_elevation_neighborhood
-        
-        tpi_interfluve_threshold = 0.5
-        interfluves_by_tpi = np.where(np.isnan(tpi), 0, (tpi > tpi_interfluve_threshold)).astype(np.uint8)
+logger.info("Calculating interfluves by distance and combining with TPI tile by tile...")
+try:
+    with rasterio.open(streams_wbt_path_abs) as streams_src, \
+         rasterio.open(interfluves_tpi_path_abs) as tpi_mask_src, \
+         rasterio.open(final_streams_path_abs, 'w', **streams_profile) as streams_dst, \
+         rasterio.open(interfluves_dist_path_abs, 'w', **profile_uint8_nodata0) as dist_dst, \
+         rasterio.open(combined_interfluves_path_abs, 'w', **profile_uint8_nodata0) as combined_dst:
+        if (streams_src.height, streams_src.width) != (dem_height, dem_width):
+            logger.warning(f"Stream raster shape {(streams_src.height, streams_src.width)} differs from DEM ({dem_height}, {dem_width}). This might be an issue.")
 
-        # Use initial_profile as base for TPI output, then update for float32/NaN nodata
-        tpi_profile_out = initial_profile.copy() 
-        tpi_profile_out.update(dtype=rasterio.float32, nodata=np.float32(np.nan), compress='lzw', count=1)
-        with rasterio.open(tpi_path_abs, 'w', **tpi_profile_out) as dst:
-            dst.write(tpi.astype(rasterio.float32), 1)
-        logger.info(f"TPI raster saved to {tpi_path_abs}")
+        for _, window in dist_dst.block_windows(1):
+            read_window, interior = padded_window(window, distance_interfluve_threshold_pixels, dem_height, dem_width)
 
-        with rasterio.open(interfluves_tpi_path_abs, 'w', **profile_uint8_nodata0) as dst:
-            dst.write(interfluves_by_tpi, 1)
-        logger.info(f"Interfluves by TPI saved to {interfluves_tpi_path_abs}")
+            streams_tile = streams_src.read(1, window=read_window).astype(np.uint8, copy=False)
+            binary_streams = streams_tile > 0 # Computed once per tile; the dilation works on it directly
+            interfluves_by_distance = stage_distance(binary_streams, distance_interfluve_threshold_pixels, interior)
 
-        logger.info("Combining distance and TPI methods for interfluves...")
-        if interfluves_by_distance.shape == interfluves_by_tpi.shape:
-            combined_interfluves = (interfluves_by_distance & interfluves_by_tpi).astype(np.uint8)
-            with rasterio.open(combined_interfluves_path_abs, 'w', **profile_uint8_nodata0) as dst:
-                dst.write(combined_interfluves, 1)
-            logger.info(f"Combined interfluves saved to {combined_interfluves_path_abs}")
-        else:
-            logger.warning(f"Shapes of distance ({interfluves_by_distance.shape}) and TPI ({interfluves_by_tpi.shape}) interfluve arrays do not match. Skipping combination.")
-    else:
-        logger.error("Could not prepare DEM for TPI. Skipping TPI-based interfluve analysis.")
-else:
-    logger.error("streams_numpy_array is None. Processing halted before interfluve analysis.")
+            interfluves_by_tpi = tpi_mask_src.read(1, window=window)
+            combined_interfluves = np.empty_like(interfluves_by_distance)
+            and_u8(interfluves_by_distance, interfluves_by_tpi, combined_interfluves)
+
+            streams_dst.write(streams_tile[interior], 1, window=window)
+            dist_dst.write(interfluves_by_distance, 1, window=window)
+            combined_dst.write(combined_interfluves, 1, window=window)
+except Exception as e:
+    logger.error(f"Failed during tiled interfluve analysis: {e}", exc_info=True)
+    exit()
+shutil.rmtree(wbt_scratch_dir, ignore_errors=True) # Free the tmpfs intermediates now; the atexit hook is then a no-op
+
+logger.info(f"Processed streams raster saved to {final_streams_path_abs}")
+logger.info(f"Interfluves by distance saved to {interfluves_dist_path_abs}")
+logger.info(f"Combined interfluves saved to {combined_interfluves_path_abs}")
 
 logger.info(f"Processing complete. Check the output_data subdirectories.")
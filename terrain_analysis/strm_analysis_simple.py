@@ -1,17 +1,157 @@
 import pysheds
 from pysheds.grid import Grid
+from pysheds.sview import Raster
 import numpy as np
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-from scipy.ndimage import generic_filter, distance_transform_edt
 import matplotlib.pyplot as plt
+from numba import njit, prange
 import os
 import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from interfluve_kernels import nodata_fill_and_weights
+try:
+    import cv2 # Optional: OpenCV's SIMD distance transform is much faster than SciPy's EDT
+except ImportError:
+    cv2 = None
+try:
+    import cupy as cp # Optional: GPU path for the EDT and the TPI box mean on large DEMs
+    from cupyx.scipy.ndimage import uniform_filter as cp_uniform_filter
+    from cucim.core.operations.morphology import distance_transform_edt as cp_distance_transform_edt
+    gpu_available = cp.cuda.runtime.getDeviceCount() > 0
+except Exception: # ImportError, or CuPy installed without a usable CUDA device
+    gpu_available = False
+gpu_min_pixels = 4_000_000 # Below this, transfer overhead outweighs the GPU speedup
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# D8 codes in pysheds' default dirmap order (N, NE, E, SE, S, SW, W, NW) and their row/col offsets
+D8_CODES = np.array([64, 128, 1, 2, 4, 8, 16, 32], dtype=np.int64)
+D8_ROW_OFFSETS = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+D8_COL_OFFSETS = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+@njit(cache=True)
+def d8_accumulation(fdir):
+    """
+    D8 flow accumulation in cells (each cell counts itself, as in grid.accumulation) using Kahn's topological
+    order: cells without upstream neighbours are processed first and pass their total to their receiver.
+    Any value that is not a D8 code (0, pits -1, flats -2) or that points off the grid is a sink.
+    Runs serially, since concurrent adds into a shared receiver would race; it is a single O(N) pass.
+    """
+    nrows, ncols = fdir.shape
+    n = nrows * ncols
+    receiver = np.full(n, -1, dtype=np.int64)
+    in_degree = np.zeros(n, dtype=np.int64)
+    for r in range(nrows):
+        for c in range(ncols):
+            code = fdir[r, c]
+            for k in range(8):
+                if code == D8_CODES[k]:
+                    rr = r + D8_ROW_OFFSETS[k]
+                    cc = c + D8_COL_OFFSETS[k]
+                    if 0 <= rr < nrows and 0 <= cc < ncols:
+                        dest = rr * ncols + cc
+                        receiver[r * ncols + c] = dest
+                        in_degree[dest] += 1
+                    break
+
+    acc = np.ones(n, dtype=np.float64)
+    stack = np.empty(n, dtype=np.int64)
+    top = 0
+    for i in range(n):
+        if in_degree[i] == 0:
+            stack[top] = i
+            top += 1
+    while top > 0:
+        top -= 1
+        i = stack[top]
+        dest = receiver[i]
+        if dest >= 0:
+            acc[dest] += acc[i]
+            in_degree[dest] -= 1
+            if in_degree[dest] == 0:
+                stack[top] = dest
+                top += 1
+    return acc.reshape(nrows, ncols)
+
+EDT_FAR = 1e20 # Stand-in for "infinitely far" parabola intersections in the distance transform
+SQ_DIST_MAX = np.iinfo(np.int32).max # Squared distances saturate here (far beyond any threshold we use)
+
+@njit(cache=True)
+def _squared_dt_1d(f, d, v, z):
+    """
+    1D squared distance transform of the integer sampled function f into d (Felzenszwalb & Huttenlocher, lower
+    envelope of parabolas). v (int) and z (float, length n + 1) are caller-provided scratch buffers; only the
+    parabola intersections z are fractional, f and d stay integer.
+    """
+    n = f.shape[0]
+    k = 0
+    v[0] = 0
+    z[0] = -EDT_FAR
+    z[1] = EDT_FAR
+    for q in range(1, n):
+        s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k])
+        while s <= z[k]:
+            k -= 1
+            s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k])
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k + 1] = EDT_FAR
+    k = 0
+    for q in range(n):
+        while z[k + 1] < q:
+            k += 1
+        d[q] = (q - v[k]) * (q - v[k]) + f[v[k]]
+
+@njit(parallel=True, cache=True)
+def squared_edt_fh(features):
+    """
+    Squared Euclidean distance (in pixels, int32) from every cell to the nearest True cell of `features`, as two
+    separable 1D passes (columns, then rows). Every column and row is independent, so both passes run in
+    parallel. Values saturate at SQ_DIST_MAX; that never changes a cell whose true value is below it, so
+    threshold tests against squared thresholds are exact and no sqrt or float64 array is needed.
+    """
+    nrows, ncols = features.shape
+    sq_dist = np.empty((nrows, ncols), dtype=np.int32)
+    for c in prange(ncols):
+        f = np.empty(nrows, dtype=np.int64)
+        d = np.empty(nrows, dtype=np.int64)
+        v = np.empty(nrows, dtype=np.int64)
+        z = np.empty(nrows + 1, dtype=np.float64)
+        for r in range(nrows):
+            f[r] = 0 if features[r, c] else SQ_DIST_MAX
+        _squared_dt_1d(f, d, v, z)
+        for r in range(nrows):
+            sq_dist[r, c] = min(d[r], SQ_DIST_MAX)
+    for r in prange(nrows):
+        f = sq_dist[r, :].astype(np.int64)
+        d = np.empty(ncols, dtype=np.int64)
+        v = np.empty(ncols, dtype=np.int64)
+        z = np.empty(ncols + 1, dtype=np.float64)
+        _squared_dt_1d(f, d, v, z)
+        for c in range(ncols):
+            sq_dist[r, c] = min(d[c], SQ_DIST_MAX)
+    return sq_dist
+
+def box_mean(arr, k):
+    """
+    k x k (odd k) moving-window mean from an integral image: after one cumsum sweep per axis every window
+    sum is four lookups, so the cost does not grow with k (no FFT path needed for larger multi-scale kernels).
+    Sums accumulate in float64; edges are mirrored like np.pad(mode='reflect').
+    """
+    if gpu_available and arr.size >= gpu_min_pixels:
+        return cp.asnumpy(cp_uniform_filter(cp.asarray(arr), size=k, mode='mirror'))
+    pad = k // 2
+    integral = np.zeros((arr.shape[0] + 2 * pad + 1, arr.shape[1] + 2 * pad + 1), dtype=np.float64)
+    np.cumsum(np.pad(arr, pad, mode='reflect'), axis=0, dtype=np.float64, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    window_sum = integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+    return (window_sum / (k * k)).astype(arr.dtype, copy=False)
+
 actual_dem_path_for_pysheds = "input_data/dem/gee_srtm_aoi.tif"
 # Define base output dirs for convenience
 output_interfluves_dir = "output_data/interfluves/"
@@ -19,6 +159,31 @@ output_intermediate_dir = "output_data/intermediate_outputs/"
 os.makedirs(output_interfluves_dir, exist_ok=True)
 os.makedirs(output_intermediate_dir, exist_ok=True)
 
+# GeoTIFF creation options for the outputs: tiled LZW with a predictor (2 for the integer masks, 3 for the
+# float32 TPI) writes fewer bytes than stripped LZW and lets GDAL compress tiles on all cores.
+uint8_creation_options = {'compress': 'lzw', 'predictor': 2, 'tiled': True,
+                          'blockxsize': 512, 'blockysize': 512, 'num_threads': 'all_cpus'}
+float32_creation_options = {'compress': 'lzw', 'predictor': 3, 'tiled': True,
+                            'blockxsize': 512, 'blockysize': 512, 'num_threads': 'all_cpus'}
+# GDAL reads these config options from the environment; setdefault keeps any values the user exported
+os.environ.setdefault('GDAL_CACHEMAX', '512')
+os.environ.setdefault('GDAL_NUM_THREADS', 'ALL_CPUS')
+os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE')
+
+# Each output is handed to a writer thread as soon as its array is ready, so LZW encoding overlaps with the
+# remaining analysis and with the other writes (rasterio releases the GIL inside GDAL).
+# Arrays submitted here must not be modified afterwards.
+output_writer = ThreadPoolExecutor(max_workers=min(5, os.cpu_count() or 1))
+output_write_futures = []
+
+def write_raster(path, array, profile, label):
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array, 1)
+    logger.info(f"{label} saved to {path}")
+
+def submit_write(path, array, profile, label):
+    output_write_futures.append(output_writer.submit(write_raster, path, array, profile, label))
+
 if not os.path.exists(actual_dem_path_for_pysheds):
     logger.critical(f"CRITICAL: DEM file not found at {actual_dem_path_for_pysheds}")
     exit()
@@ -40,6 +205,11 @@ else: # Fallback for SRTM int16 if needed
     else: grid.nodata = np.array(0, dtype=dem_raster_view.dtype).item() if dem_raster_view.dtype else 0
 logger.info(f"Grid properties after read_raster: Nodata={grid.nodata} (type: {type(grid.nodata)})")
 
+# Materialize the DEM as a plain ndarray once and reuse it for TPI. For an sview.Raster this is a view (no copy);
+# it is never modified in place.
+dem_original_nodata_val = grid.nodata.item() if hasattr(grid.nodata, 'item') else grid.nodata
+dem_np = dem_raster_view.filled(dem_original_nodata_val) if hasattr(dem_raster_view, 'filled') else np.asarray(dem_raster_view)
+
 
 logger.info("Filling depressions...")
 flooded_dem_raster_view = grid.fill_depressions(dem=dem_raster_view, out_name='flooded_dem')
@@ -47,29 +217,35 @@ logger.info(f"Depressions filled. Output type: {type(flooded_dem_raster_view)}")
 logger.debug(f"flooded_dem_raster_view properties: dtype={flooded_dem_raster_view.dtype}, nodata={getattr(flooded_dem_raster_view, 'nodata', 'N/A')}")
 
 
+@contextlib.contextmanager
+def nodata_scope(grid, value):
+    """Temporarily sets grid.nodata for the PySheds calls inside the block and restores it once afterwards."""
+    backup = grid.nodata
+    logger.debug(f"Temporarily setting grid.nodata to {value} (type {type(value)}).")
+    grid.nodata = value
+    try:
+        yield grid
+    finally:
+        grid.nodata = backup
+        logger.debug(f"Restored grid.nodata to: {grid.nodata} (type: {type(grid.nodata)})")
+
 logger.info("Calculating flow direction...")
 fdir_raster_view = None
 if flooded_dem_raster_view is not None:
-    grid_nodata_backup_fdir = grid.nodata # Backup main grid nodata
     # For flowdir output, its sview.Raster is created using main grid's current nodata context.
     # We will set nodata_out=None for fdir_raster_view itself.
     # The temporary grid.nodata is for the sview.Raster constructor of fdir output.
     # If fdir output data itself does not have nodata, then grid.nodata=None might be best.
-    
-    logger.debug(f"Temporarily setting grid.nodata to None for FLOWDIR output context.")
-    grid.nodata = None # Try None for the output viewfinder context
-    try:
-        # Set nodata_out=None for the fdir_raster_view's own .nodata attribute
-        fdir_raster_view = grid.flowdir(dem=flooded_dem_raster_view, out_name='fdir', nodata_out=None)
-        logger.info(f"Flow direction calculated. Output type: {type(fdir_raster_view)}")
-        logger.debug(f"fdir_raster_view properties: dtype={fdir_raster_view.dtype}, nodata={getattr(fdir_raster_view, 'nodata', 'N/A')}")
-        # We expect fdir_raster_view.nodata to be None
-    except Exception as e:
-        logger.error(f"Error during grid.flowdir: {e}", exc_info=True)
-        raise
-    finally:
-        grid.nodata = grid_nodata_backup_fdir # Restore
-        logger.debug(f"Restored grid.nodata to: {grid.nodata} (type: {type(grid.nodata)})")
+    with nodata_scope(grid, None):
+        try:
+            # Set nodata_out=None for the fdir_raster_view's own .nodata attribute
+            fdir_raster_view = grid.flowdir(dem=flooded_dem_raster_view, out_name='fdir', nodata_out=None)
+            logger.info(f"Flow direction calculated. Output type: {type(fdir_raster_view)}")
+            logger.debug(f"fdir_raster_view properties: dtype={fdir_raster_view.dtype}, nodata={getattr(fdir_raster_view, 'nodata', 'N/A')}")
+            # We expect fdir_raster_view.nodata to be None
+        except Exception as e:
+            logger.error(f"Error during grid.flowdir: {e}", exc_info=True)
+            raise
 else:
     logger.error("Flooded DEM is None.")
     exit()
@@ -82,13 +258,12 @@ if fdir_raster_view is not None:
     # Accumulation output sview.Raster uses fdir_raster_view.viewfinder.
     # If fdir_raster_view.nodata is None, the np.can_cast check in sview.Raster.__new__ should be skipped.
     try:
-        grid.accumulation(fdir=fdir_raster_view, out_name='acc')
-        logger.info(f"Flow accumulation calculated.")
-        acc_raster_view = grid.get_data('acc', return_sview=True)
-        logger.info(f"Accumulation accessed. Output type: {type(acc_raster_view)}")
+        # Compiled Kahn propagation instead of grid.accumulation; wrapped on fdir's viewfinder for extract_river_network
+        acc_raster_view = Raster(d8_accumulation(np.asarray(fdir_raster_view)), viewfinder=fdir_raster_view.viewfinder)
+        logger.info(f"Flow accumulation calculated. Output type: {type(acc_raster_view)}")
         logger.debug(f"acc_raster_view properties: dtype={acc_raster_view.dtype}, nodata={getattr(acc_raster_view, 'nodata', 'N/A')}")
     except Exception as e:
-        logger.error(f"Error during/after grid.accumulation: {e}", exc_info=True)
+        logger.error(f"Error during flow accumulation: {e}", exc_info=True)
         raise
 else:
     logger.error("Flow direction is None.")
@@ -98,23 +273,18 @@ else:
 logger.info("Extracting stream network...")
 streams_raster_view = None
 if acc_raster_view is not None and fdir_raster_view is not None :
-    grid_nodata_backup_streams = grid.nodata
     streams_out_nodata_typed = np.uint8(0)
-    
-    logger.debug(f"Temporarily setting grid.nodata to {streams_out_nodata_typed} (type {type(streams_out_nodata_typed)}) for STREAMS output context.")
-    grid.nodata = streams_out_nodata_typed
-    try:
-        grid.extract_river_network(fdir=fdir_raster_view, acc=acc_raster_view, threshold=1000, out_name='streams')
-        logger.info(f"Stream network extracted.")
-        streams_raster_view = grid.get_data('streams', return_sview=True)
-        logger.info(f"Streams accessed. Output type: {type(streams_raster_view)}")
-        logger.debug(f"streams_raster_view properties: dtype={streams_raster_view.dtype}, nodata={getattr(streams_raster_view, 'nodata', 'N/A')}")
-    except Exception as e:
-        logger.error(f"Error during/after grid.extract_river_network: {e}", exc_info=True)
-        raise
-    finally:
-        grid.nodata = grid_nodata_backup_streams
-        logger.debug(f"Restored grid.nodata to: {grid.nodata} (type: {type(grid.nodata)})")
+    # uint8 nodata context for the STREAMS output
+    with nodata_scope(grid, streams_out_nodata_typed):
+        try:
+            grid.extract_river_network(fdir=fdir_raster_view, acc=acc_raster_view, threshold=1000, out_name='streams')
+            logger.info(f"Stream network extracted.")
+            streams_raster_view = grid.get_data('streams', return_sview=True)
+            logger.info(f"Streams accessed. Output type: {type(streams_raster_view)}")
+            logger.debug(f"streams_raster_view properties: dtype={streams_raster_view.dtype}, nodata={getattr(streams_raster_view, 'nodata', 'N/A')}")
+        except Exception as e:
+            logger.error(f"Error during/after grid.extract_river_network: {e}", exc_info=True)
+            raise
 else:
     logger.error("Accumulation or Flow Direction is None. Cannot extract streams.")
     exit()
@@ -125,97 +295,104 @@ if streams_raster_view is not None:
     intended_streams_nodata_val = streams_out_nodata_typed.item()
 
     if hasattr(streams_raster_view, 'filled'):
-        streams_numpy_array = streams_raster_view.filled(intended_streams_nodata_val).astype(np.uint8)
+        streams_numpy_array = streams_raster_view.filled(intended_streams_nodata_val).astype(np.uint8, copy=False)
     elif isinstance(streams_raster_view, np.ndarray):
-        streams_numpy_array = streams_raster_view.astype(np.uint8)
+        streams_numpy_array = np.asarray(streams_raster_view).astype(np.uint8, copy=False)
     
     if streams_numpy_array is not None:
         streams_path = "output_data/interfluves/streams_gee.tif"
         profile = {
             'driver': 'GTiff', 'dtype': rasterio.uint8, 'nodata': intended_streams_nodata_val,
             'width': grid.shape[1], 'height': grid.shape[0], 'count': 1,
-            'crs': grid.crs, 'transform': grid.affine, 'compress': 'lzw'
+            'crs': grid.crs, 'transform': grid.affine, **uint8_creation_options
         }
-        with rasterio.open(streams_path, 'w', **profile) as dst:
-            dst.write(streams_numpy_array, 1)
-        logger.info(f"Streams raster saved to {streams_path}")
+        submit_write(streams_path, streams_numpy_array, profile, "Streams raster")
 
         logger.info("Starting Interfluve Analysis...")
         # ... (Interfluve analysis code as in the previous full script) ...
         logger.info("Calculating distance from streams...")
-        binary_streams = (streams_numpy_array > 0).astype(np.uint8)
-        distance_to_streams = distance_transform_edt(1 - binary_streams)
+        binary_streams = streams_numpy_array != 0 # bool mask, no separate uint8 copy (streams are uint8, nodata 0)
         distance_interfluve_threshold_pixels = 15
-        interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
+        if gpu_available and binary_streams.size >= gpu_min_pixels:
+            # cuCIM's 2D EDT needs explicit block_params once an axis exceeds 1024 px
+            edt_block_params = (1, 32, 2) if max(binary_streams.shape) > 1024 else None
+            distance_to_streams = cp.asnumpy(cp_distance_transform_edt(cp.asarray(~binary_streams), block_params=edt_block_params))
+            interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
+        elif cv2 is not None:
+            # DIST_MASK_PRECISE gives the exact Euclidean distance as float32 (half the memory of SciPy's float64)
+            # bool and uint8 share a layout, so the inverted mask is handed to OpenCV as a uint8 view (no cast)
+            distance_to_streams = cv2.distanceTransform(np.logical_not(binary_streams).view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            interfluves_by_distance = (distance_to_streams > distance_interfluve_threshold_pixels).astype(np.uint8)
+        else:
+            # Only the threshold test is needed, so compare integer squared distances (no sqrt)
+            squared_distance_to_streams = squared_edt_fh(binary_streams)
+            interfluves_by_distance = (squared_distance_to_streams > distance_interfluve_threshold_pixels ** 2).astype(np.uint8)
 
         interfluves_dist_path = "output_data/interfluves/interfluves_by_distance_gee.tif"
         profile_uint8_nodata0 = profile.copy()
         profile_uint8_nodata0['nodata'] = 0
         profile_uint8_nodata0['dtype'] = rasterio.uint8
 
-        with rasterio.open(interfluves_dist_path, 'w', **profile_uint8_nodata0) as dst:
-            dst.write(interfluves_by_distance, 1)
-        logger.info(f"Interfluves by distance saved to {interfluves_dist_path}")
+        submit_write(interfluves_dist_path, interfluves_by_distance, profile_uint8_nodata0, "Interfluves by distance")
 
         logger.info("Calculating TPI...")
-        dem_original_nodata_val = grid.nodata.item() if hasattr(grid.nodata, 'item') else grid.nodata
-        
-        dem_numpy_array_for_tpi = None
-        if hasattr(dem_raster_view, 'filled'):
-            dem_numpy_array_for_tpi = dem_raster_view.filled(dem_original_nodata_val).astype(np.float32)
-        elif isinstance(dem_raster_view, np.ndarray):
-            dem_numpy_array_for_tpi = dem_raster_view.astype(np.float32)
-        
-        if dem_numpy_array_for_tpi is None:
-            logger.error("Could not get NumPy array from dem_raster_view for TPI.")
-            exit("Failed to get DEM NumPy array for TPI.")
+        dem_numpy_array_for_tpi = dem_np.astype(np.float32, copy=False) # Only copies if the DEM is not float32 already
 
         tpi_profile_base = {
             'driver': 'GTiff', 'width': grid.shape[1], 'height': grid.shape[0],
-            'count': 1, 'crs': grid.crs, 'transform': grid.affine, 'compress': 'lzw'
+            'count': 1, 'crs': grid.crs, 'transform': grid.affine, **float32_creation_options
         }
         kernel_size = 9
-        pad_width = kernel_size // 2
         
-        dem_mask_for_tpi = (dem_numpy_array_for_tpi == dem_original_nodata_val)
-        valid_dem_pixels = dem_numpy_array_for_tpi[~dem_mask_for_tpi]
-        dem_mean_for_nan_replacement = np.mean(valid_dem_pixels) if valid_dem_pixels.size > 0 else 0
-        dem_array_no_nodata = np.where(dem_mask_for_tpi, dem_mean_for_nan_replacement, dem_numpy_array_for_tpi)
-        dem_array_no_nodata = np.nan_to_num(dem_array_no_nodata, nan=dem_mean_for_nan_replacement)
-        dem_padded = np.pad(dem_array_no_nodata, pad_width, mode='reflect')
+        dem_kernel_nodata = np.float32(np.nan if dem_original_nodata_val is None else dem_original_nodata_val)
+        # TPI is computed in row strips, each read with a kernel_size // 2 halo, so the filled DEM, weights and
+        # box sums only ever exist for one strip instead of as several full-size float32 arrays at once.
+        # Only the TPI itself is full size (it is written out as a whole).
+        tpi_halo = kernel_size // 2
+        tpi_strip_rows = 2048
+        tpi = np.empty(dem_numpy_array_for_tpi.shape, dtype=np.float32)
+        dem_rows = tpi.shape[0]
+        for row_start in range(0, dem_rows, tpi_strip_rows):
+            row_stop = min(row_start + tpi_strip_rows, dem_rows)
+            read_start = max(row_start - tpi_halo, 0)
+            read_stop = min(row_stop + tpi_halo, dem_rows)
+            interior = slice(row_start - read_start, row_stop - read_start)
+            dem_strip = dem_numpy_array_for_tpi[read_start:read_stop]
 
-        mean_elevation_neighborhood = generic_filter(
-            dem_padded, np.mean, size=kernel_size, mode='reflect'
-        )
-        mean_elevation_neighborhood = mean_elevation_neighborhood[pad_width:-pad_width, pad_width:-pad_width]
+            # One compiled pass builds the nodata/NaN mask, the zero-filled DEM and the 0/1 weights. Nodata cells
+            # contribute neither sum nor count, so the mean is taken over valid neighbours only.
+            dem_strip_filled = np.empty_like(dem_strip)
+            valid_weights = np.empty(dem_strip.shape, dtype=np.float32) # float32, since box_mean keeps the input dtype
+            dem_strip_mask = np.empty(dem_strip.shape, dtype=np.bool_)
+            nodata_fill_and_weights(dem_strip, dem_kernel_nodata, np.float32(0), dem_strip_filled, valid_weights, dem_strip_mask)
+            neighborhood_sum = box_mean(dem_strip_filled, kernel_size)
+            neighborhood_count = box_mean(valid_weights, kernel_size)
 
-        tpi = dem_numpy_array_for_tpi - mean_elevation_neighborhood
-        tpi[dem_mask_for_tpi] = np.nan
+            # Everything from the DEM read onwards is float32 (the TPI output dtype), so no float64 temporaries
+            tpi_strip = tpi[row_start:row_stop]
+            np.divide(neighborhood_sum[interior], np.maximum(neighborhood_count[interior], np.float32(1e-6)), out=tpi_strip)
+            np.subtract(dem_strip[interior], tpi_strip, out=tpi_strip)
+            tpi_strip[dem_strip_mask[interior]] = np.float32(np.nan)
 
-        tpi_interfluve_threshold = 0.5
-        interfluves_by_tpi = np.where(np.isnan(tpi), 0, (tpi > tpi_interfluve_threshold)).astype(np.uint8)
+        tpi_interfluve_threshold = np.float32(0.5)
+        interfluves_by_tpi = (tpi > tpi_interfluve_threshold).astype(np.uint8) # NaN compares False, so nodata stays 0
 
         tpi_path = "output_data/intermediate_outputs/tpi_gee.tif"
         interfluves_tpi_path = "output_data/interfluves/interfluves_by_tpi_gee.tif"
         
         tpi_profile_out = tpi_profile_base.copy()
         tpi_profile_out.update(dtype=rasterio.float32, nodata=np.float32(np.nan))
-        with rasterio.open(tpi_path, 'w', **tpi_profile_out) as dst:
-            dst.write(tpi.astype(rasterio.float32), 1)
+        submit_write(tpi_path, tpi.astype(rasterio.float32, copy=False), tpi_profile_out, "TPI")
 
         interfluve_tpi_profile_out = profile_uint8_nodata0.copy()
-        with rasterio.open(interfluves_tpi_path, 'w', **interfluve_tpi_profile_out) as dst:
-            dst.write(interfluves_by_tpi, 1)
-        logger.info(f"TPI saved to {tpi_path}")
-        logger.info(f"Interfluves by TPI saved to {interfluves_tpi_path}")
+        submit_write(interfluves_tpi_path, interfluves_by_tpi, interfluve_tpi_profile_out, "Interfluves by TPI")
 
         logger.info("Combining distance and TPI methods for interfluves...")
         if interfluves_by_distance.shape == interfluves_by_tpi.shape:
-            combined_interfluves = (interfluves_by_distance & interfluves_by_tpi).astype(np.uint8)
+            # Both masks may still be being written, so the result gets its own buffer (already uint8, no extra cast)
+            combined_interfluves = interfluves_by_distance & interfluves_by_tpi
             combined_interfluves_path = "output_data/interfluves/combined_interfluves_gee.tif"
-            with rasterio.open(combined_interfluves_path, 'w', **profile_uint8_nodata0) as dst:
-                dst.write(combined_interfluves, 1)
-            logger.info(f"Combined interfluves saved to {combined_interfluves_path}")
+            submit_write(combined_interfluves_path, combined_interfluves, profile_uint8_nodata0, "Combined interfluves")
         else:
             logger.warning("Shapes of distance and TPI interfluve arrays do not match. Skipping combination.")
 
@@ -224,4 +401,7 @@ if streams_raster_view is not None:
 else:
     logger.error("streams_raster_view is None. Processing halted before saving streams.")
 
+output_writer.shutdown(wait=True)
+for future in output_write_futures:
+    future.result() # Re-raises any error from the writer threads
 logger.info("Processing complete. Check the output_data subdirectories.")
@@ -1,6 +1,7 @@
 import folium
 import os
 import json # Still good to have for opening/inspecting GeoJSON if needed
+from simplified_borders import load_simplified_borders, border_style
 
 # --- Configuration ---
 output_html_map = "output_data/maps/aoi_with_simple_borders_map.html"
@@ -51,17 +52,10 @@ if __name__ == "__main__":
 
     # --- Add Country Borders from GeoJSON (Simplified) ---
     try:
-        def style_function(feature):
-            return {
-                'fillOpacity': 0,
-                'weight': 1.5,
-                'color': '#FFFF00' # Bright yellow
-            }
-
         borders_overlay = folium.GeoJson(
-            country_borders_geojson_path,
+            load_simplified_borders(country_borders_geojson_path, (min_lon, min_lat, max_lon, max_lat)),
             name="Country Borders", # Simplified name
-            style_function=style_function
+            style_function=lambda feature: border_style
             # NO TOOLTIP if properties are empty
         )
         borders_overlay.add_to(m)
@@ -48,17 +48,35 @@ m = folium.Map(
     attr=google_attribution
 )
 
-# 4. Add the rectangular areas and labels to the map
-for area in areas_data:
-    folium.Rectangle(
-        bounds=area["bounds"],
-        color=area["color"],
-        fill=True,
-        fill_color=area["color"],
-        fill_opacity=0.2,
-        tooltip=f"<b>{area['name']}</b><br>{area['description']}"
-    ).add_to(m)
+# 4. Add the rectangular areas as one GeoJson layer (one Leaflet layer and one shared tooltip template
+# instead of a separate Rectangle with its own tooltip HTML per area), plus a marker at each area center
+def rectangle_coords(bounds):
+    (south, west), (north, east) = bounds
+    return [[west, south], [east, south], [east, north], [west, north], [west, south]] # GeoJSON is [lon, lat]
+
+areas_geojson = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [rectangle_coords(area["bounds"])]},
+            "properties": {"name": area["name"], "description": area["description"], "color": area["color"]}
+        }
+        for area in areas_data
+    ]
+}
+folium.GeoJson(
+    areas_geojson,
+    name="Research Areas",
+    style_function=lambda feature: {
+        "color": feature["properties"]["color"],
+        "fillColor": feature["properties"]["color"],
+        "fillOpacity": 0.2
+    },
+    tooltip=folium.GeoJsonTooltip(fields=["name", "description"], labels=False)
+).add_to(m)
 
+for area in areas_data:
     folium.Marker(
         location=area["center"],
         tooltip=f"<b>{area['name']}</b>",
@@ -2,6 +2,9 @@ import folium
 import ee
 import os
 import json # For GeoJSON inspection if needed
+from simplified_borders import load_simplified_borders, border_style
+import hashlib
+import time
 from dotenv import load_dotenv # Import load_dotenv
 
 # --- Load Environment Variables ---
@@ -9,38 +12,40 @@ load_dotenv() # Load variables from .env file into environment
 gcp_project_id = os.getenv('GCP_PROJECT_ID') # Get your GCP Project ID
 
 # --- Earth Engine Initialization ---
-try:
-    if not gcp_project_id:
-        print("ERROR: GCP_PROJECT_ID not found in environment variables.")
-        print("Please ensure it is set in your .env file or system environment.")
-        exit()
-
-    # Initialize with the Google Cloud Project ID
-    ee.Initialize(project=gcp_project_id, opt_url='https://earthengine-highvolume.googleapis.com')
-    print(f"Google Earth Engine initialized successfully with project: {gcp_project_id}.")
-
-except ee.EEException as e:
-    print(f"ERROR: Could not initialize Google Earth Engine with project '{gcp_project_id}'.")
-    print(f"Details: {e}")
-    if "not found" in str(e) or "verify the project ID" in str(e):
-        print(f"Please double-check that '{gcp_project_id}' is a valid Google Cloud Project ID and that the Earth Engine API is enabled for it.")
-    if "user does not have access" in str(e):
-         print("Please ensure your authenticated user has permissions (e.g., Earth Engine User, Viewer) on this GCP project.")
-    # Attempt to authenticate if initialization fails (might not always resolve project issues but good for user auth)
+# Only needed when the GEDI tile URL is not cached (see below), so it is done lazily.
+def initialize_ee():
     try:
-        print("\nAttempting user authentication (this may open a browser window or prompt for a code)...")
-        ee.Authenticate() # This will guide you through authentication if not already done.
-        # Retry initialization after authentication
+        if not gcp_project_id:
+            print("ERROR: GCP_PROJECT_ID not found in environment variables.")
+            print("Please ensure it is set in your .env file or system environment.")
+            exit()
+
+        # Initialize with the Google Cloud Project ID
         ee.Initialize(project=gcp_project_id, opt_url='https://earthengine-highvolume.googleapis.com')
-        print(f"Google Earth Engine initialized successfully with project '{gcp_project_id}' after re-authentication attempt.")
-    except Exception as auth_e:
-        print(f"Secondary authentication/initialization attempt failed: {auth_e}")
-        print("Please ensure you have run 'earthengine authenticate' in your terminal and followed the prompts,")
-        print("and that the GCP_PROJECT_ID is correct and has Earth Engine API enabled.")
-        exit() # Exit if EE cannot be initialized, as it's critical.
-except Exception as general_e:
-    print(f"An unexpected error occurred during Earth Engine initialization: {general_e}")
-    exit()
+        print(f"Google Earth Engine initialized successfully with project: {gcp_project_id}.")
+
+    except ee.EEException as e:
+        print(f"ERROR: Could not initialize Google Earth Engine with project '{gcp_project_id}'.")
+        print(f"Details: {e}")
+        if "not found" in str(e) or "verify the project ID" in str(e):
+            print(f"Please double-check that '{gcp_project_id}' is a valid Google Cloud Project ID and that the Earth Engine API is enabled for it.")
+        if "user does not have access" in str(e):
+             print("Please ensure your authenticated user has permissions (e.g., Earth Engine User, Viewer) on this GCP project.")
+        # Attempt to authenticate if initialization fails (might not always resolve project issues but good for user auth)
+        try:
+            print("\nAttempting user authentication (this may open a browser window or prompt for a code)...")
+            ee.Authenticate() # This will guide you through authentication if not already done.
+            # Retry initialization after authentication
+            ee.Initialize(project=gcp_project_id, opt_url='https://earthengine-highvolume.googleapis.com')
+            print(f"Google Earth Engine initialized successfully with project '{gcp_project_id}' after re-authentication attempt.")
+        except Exception as auth_e:
+            print(f"Secondary authentication/initialization attempt failed: {auth_e}")
+            print("Please ensure you have run 'earthengine authenticate' in your terminal and followed the prompts,")
+            print("and that the GCP_PROJECT_ID is correct and has Earth Engine API enabled.")
+            exit() # Exit if EE cannot be initialized, as it's critical.
+    except Exception as general_e:
+        print(f"An unexpected error occurred during Earth Engine initialization: {general_e}")
+        exit()
 
 
 # --- Configuration ---
@@ -80,26 +85,56 @@ center_lat_aoi = (min_lat_aoi + max_lat_aoi) / 2
 center_lon_aoi = (min_lon_aoi + max_lon_aoi) / 2
 
 # --- GEDI Data Processing with Earth Engine ---
-amazon_roi_ee = ee.Geometry.Rectangle([-80, -20, -45, 10]) # [lon_min, lat_min, lon_max, lat_max]
-gedi_l2a_monthly_collection = ee.ImageCollection("LARSE/GEDI/GEDI02_A_002_MONTHLY")
-gedi_coverage_quality_mosaic = gedi_l2a_monthly_collection \
-    .filterBounds(amazon_roi_ee) \
-    .select('quality_flag') \
-    .mosaic()
-gedi_binary_coverage = gedi_coverage_quality_mosaic.eq(1).selfMask()
+# The mosaic is fully determined by the asset, ROI and vis params, so its tile URL is cached on disk
+# (keyed by a hash of those) and Earth Engine is only contacted when the cache is missing or stale.
+# The URL embeds a getMapId token that Earth Engine expires after a few hours, so the TTL is kept well
+# below that. Delete the cache file if the GEDI tiles stop loading before the TTL runs out.
+gedi_asset_id = "LARSE/GEDI/GEDI02_A_002_MONTHLY"
+amazon_roi_coords = [-80, -20, -45, 10] # [lon_min, lat_min, lon_max, lat_max]
 gedi_vis_params = {
     'palette': ['00AA00'],
     'opacity': 0.6
 }
-gedi_tiles_url = None
-try:
-    gedi_map_id_object = gedi_binary_coverage.getMapId(gedi_vis_params)
-    gedi_tiles_url = gedi_map_id_object['tile_fetcher'].url_format
-    print("GEDI coverage layer processed by Earth Engine and tile URL obtained.")
-except Exception as e:
-    print(f"Error getting GEDI layer from Earth Engine: {e}")
-    print("The map will be generated without the GEDI layer.")
+gedi_tile_cache_dir = "output_data/cache"
+gedi_tile_cache_max_age_s = 2 * 3600 # Rapid reruns reuse it; a new session fetches a fresh map ID
+gedi_cache_key = hashlib.sha256(
+    json.dumps([gedi_asset_id, amazon_roi_coords, gedi_vis_params], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+gedi_tile_cache_path = os.path.join(gedi_tile_cache_dir, f"{gedi_cache_key}.json")
+
+def get_gedi_tiles_url():
+    if os.path.exists(gedi_tile_cache_path):
+        try:
+            with open(gedi_tile_cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if time.time() - cached['timestamp'] < gedi_tile_cache_max_age_s:
+                print(f"GEDI coverage tile URL loaded from cache ({gedi_tile_cache_path}).")
+                return cached['url_format']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable GEDI tile URL cache {gedi_tile_cache_path}: {e}")
+
+    initialize_ee()
+    amazon_roi_ee = ee.Geometry.Rectangle(amazon_roi_coords)
+    gedi_l2a_monthly_collection = ee.ImageCollection(gedi_asset_id)
+    gedi_coverage_quality_mosaic = gedi_l2a_monthly_collection \
+        .filterBounds(amazon_roi_ee) \
+        .select('quality_flag') \
+        .mosaic()
+    gedi_binary_coverage = gedi_coverage_quality_mosaic.eq(1).selfMask()
+    try:
+        gedi_map_id_object = gedi_binary_coverage.getMapId(gedi_vis_params)
+        url_format = gedi_map_id_object['tile_fetcher'].url_format
+        print("GEDI coverage layer processed by Earth Engine and tile URL obtained.")
+    except Exception as e:
+        print(f"Error getting GEDI layer from Earth Engine: {e}")
+        print("The map will be generated without the GEDI layer.")
+        return None
+
+    os.makedirs(gedi_tile_cache_dir, exist_ok=True)
+    with open(gedi_tile_cache_path, "w", encoding="utf-8") as f:
+        json.dump({'url_format': url_format, 'timestamp': time.time()}, f)
+    return url_format
 
+gedi_tiles_url = get_gedi_tiles_url()
 
 # --- Main Folium Map Script ---
 if __name__ == "__main__":
@@ -136,16 +171,10 @@ if __name__ == "__main__":
 
     if os.path.exists(country_borders_geojson_path):
         try:
-            def style_function_borders(feature):
-                return {
-                    'fillOpacity': 0,
-                    'weight': 1.5,
-                    'color': '#FFFF00'
-                }
             borders_overlay = folium.GeoJson(
-                country_borders_geojson_path,
+                load_simplified_borders(country_borders_geojson_path, (min_lon_aoi, min_lat_aoi, max_lon_aoi, max_lat_aoi)),
                 name="Country Borders",
-                style_function=style_function_borders
+                style_function=lambda feature: border_style
             )
             borders_overlay.add_to(m)
             print("Country borders GeoJSON layer added to Folium map.")
@@ -1,5 +1,6 @@
 import folium
 import rasterio
+from rasterio.warp import transform_bounds
 import os
 import time
 from selenium import webdriver
@@ -41,8 +42,7 @@ def get_raster_bounds(tiff_path):
                 return folium_bounds
             else:
                 # If projected, transform to WGS84 (EPSG:4326)
-                from rasterio.warp import transform_bounds
-                wgs84_bounds = transform_bounds(src.crs, {'init': 'epsg:4326'}, *src.bounds)
+                wgs84_bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
                 # wgs84_bounds gives (west_lon, south_lat, east_lon, north_lat)
                 folium_bounds = [[wgs84_bounds[1], wgs84_bounds[0]], [wgs84_bounds[3], wgs84_bounds[2]]]
                 print(f"Raster projected bounds transformed to WGS84 (lat/lon): {folium_bounds}")
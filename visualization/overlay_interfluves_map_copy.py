@@ -1,14 +1,11 @@
 import folium
 import rasterio
+from rasterio.warp import transform_bounds
 import os
 import time
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service as ChromeService
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-from scipy.ndimage import binary_dilation # For dilation
+from PIL import Image
+from overlay_rendering import dilate_mask, tpi_colormap_lut, tpi_to_rgba
 
 # --- Configuration ---
 reference_dem_tiff_path = "output_data/processed_dem/gee_srtm_aoi_wbt_compat.tif"
@@ -24,6 +21,15 @@ CHROME_DRIVER_PATH = r"C:\Users\larry\Downloads\chromedriver-win64\chromedriver.
 USE_SELENIUM = False
 
 # --- Get Bounding Box (same as before) ---
+def dataset_folium_bounds(src):
+    """[[south, west], [north, east]] in lat/lon for an open rasterio dataset."""
+    if src.crs.is_geographic:
+        bounds = src.bounds
+        return [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
+    else:
+        wgs84_bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+        return [[wgs84_bounds[1], wgs84_bounds[0]], [wgs84_bounds[3], wgs84_bounds[2]]]
+
 def get_raster_bounds(tiff_path):
     # ... (keep the existing get_raster_bounds function)
     if not os.path.exists(tiff_path):
@@ -31,17 +37,7 @@ def get_raster_bounds(tiff_path):
         return None
     try:
         with rasterio.open(tiff_path) as src:
-            if src.crs.is_geographic:
-                bounds = src.bounds
-                folium_bounds = [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
-                # print(f"Raster geographic bounds (lat/lon) for {os.path.basename(tiff_path)}: {folium_bounds}")
-                return folium_bounds
-            else:
-                from rasterio.warp import transform_bounds
-                wgs84_bounds = transform_bounds(src.crs, {'init': 'epsg:4326'}, *src.bounds)
-                folium_bounds = [[wgs84_bounds[1], wgs84_bounds[0]], [wgs84_bounds[3], wgs84_bounds[2]]]
-                # print(f"Raster projected bounds for {os.path.basename(tiff_path)} transformed to WGS84 (lat/lon): {folium_bounds}")
-                return folium_bounds
+            return dataset_folium_bounds(src)
     except Exception as e:
         print(f"Error reading bounds from {tiff_path}: {e}")
         return None
@@ -55,15 +51,17 @@ def create_enhanced_overlay_png(source_tiff_path, target_png_path,
     """
     Creates a PNG from a single-band GeoTIFF for overlay, with dilation for binary features.
     For TPI or continuous data, dilation is usually not desired, so it's skipped.
+    Returns (success, folium_bounds); the bounds are taken from the already open source so the
+    caller does not have to open the TIFF again to place the overlay.
     """
     if not os.path.exists(source_tiff_path):
         print(f"Error: Overlay source TIFF not found at {source_tiff_path}")
-        return False
+        return False, None
     try:
         with rasterio.open(source_tiff_path) as src:
             data = src.read(1)
             height, width = data.shape
-            rgba = np.zeros((height, width, 4), dtype=np.uint8) # R, G, B, Alpha
+            rgba = np.empty((height, width, 4), dtype=np.uint8) # R, G, B, Alpha; every branch below writes every pixel
 
             is_binary_interfluve_map = 'interfluves' in os.path.basename(source_tiff_path) or \
                                      'streams' in os.path.basename(source_tiff_path)
@@ -78,53 +76,42 @@ def create_enhanced_overlay_png(source_tiff_path, target_png_path,
                     # A structure can be provided, but a default (cross-shaped structuring element) is fine.
                     # Iterations=1 dilates by 1 pixel. Iterations=2 dilates by 2 pixels etc.
                     # Visually, dilation_iterations=2 will make features about 5 pixels wider (2 on each side + original).
-                    dilated_mask = binary_dilation(binary_mask, iterations=dilation_iterations)
+                    dilated_mask = dilate_mask(binary_mask, dilation_iterations)
                     mask_to_color = dilated_mask
                     print(f"Applied dilation with {dilation_iterations} iterations.")
                 else:
                     mask_to_color = binary_mask # No dilation
 
-                rgba[mask_to_color, 0] = color[0]
-                rgba[mask_to_color, 1] = color[1]
-                rgba[mask_to_color, 2] = color[2]
-                rgba[mask_to_color, 3] = alpha
+                fill_rgba = np.array((color[0], color[1], color[2], alpha), dtype=np.uint8)
+                np.multiply(mask_to_color[..., None], fill_rgba, out=rgba) # Fill color inside the mask, 0 elsewhere, one pass
             elif 'tpi' in os.path.basename(source_tiff_path).lower():
                 # TPI Handling (as before, no dilation for TPI)
                 print("Applying TPI colormap.")
-                norm_tpi = plt.Normalize(vmin=-2, vmax=2)
-                colormap = plt.cm.RdBu_r
-                colored_tpi = colormap(norm_tpi(data))
-
-                alpha_channel_tpi = np.ones_like(data, dtype=float) * (alpha / 255.0)
-                alpha_channel_tpi[np.abs(data) < 0.25] = 0.1 * (alpha / 255.0) # Make flats very transparent but relative to overall alpha
-
-                rgba[:,:,0] = (colored_tpi[:,:,0] * 255).astype(np.uint8)
-                rgba[:,:,1] = (colored_tpi[:,:,1] * 255).astype(np.uint8)
-                rgba[:,:,2] = (colored_tpi[:,:,2] * 255).astype(np.uint8)
-                rgba[:,:,3] = (alpha_channel_tpi * 255).astype(np.uint8)
-
-                if src.nodatavals[0] is not None:
-                    nodata_mask = np.isnan(data) if np.isnan(src.nodatavals[0]) else (data == src.nodatavals[0])
-                    rgba[nodata_mask, 3] = 0
+                # Colormap over [-2, 2], flats very transparent relative to the overall alpha, nodata transparent;
+                # the alpha bytes are computed exactly as the former float alpha channel rounded them
+                tpi_nodata_val = src.nodatavals[0]
+                tpi_to_rgba(data, -2.0, 2.0, tpi_colormap_lut,
+                            np.uint8((alpha / 255.0) * 255), np.uint8((0.1 * (alpha / 255.0)) * 255),
+                            tpi_nodata_val is not None, np.nan if tpi_nodata_val is None else float(tpi_nodata_val), rgba)
             else: # Generic case (assume binary, apply dilation)
                 print("Applying generic binary colormap with dilation.")
                 binary_mask = (data != nodata_val)
                 if dilation_iterations > 0:
-                    dilated_mask = binary_dilation(binary_mask, iterations=dilation_iterations)
+                    dilated_mask = dilate_mask(binary_mask, dilation_iterations)
                     mask_to_color = dilated_mask
                 else:
                     mask_to_color = binary_mask
-                rgba[mask_to_color, 0] = color[0]
-                rgba[mask_to_color, 1] = color[1]
-                rgba[mask_to_color, 2] = color[2]
-                rgba[mask_to_color, 3] = alpha
+                fill_rgba = np.array((color[0], color[1], color[2], alpha), dtype=np.uint8)
+                np.multiply(mask_to_color[..., None], fill_rgba, out=rgba) # Fill color inside the mask, 0 elsewhere, one pass
 
-            plt.imsave(target_png_path, rgba)
+            # rgba is already the final uint8 image, so it is written straight to PNG (no matplotlib figure/Agg
+            # round trip); the overlay is mostly empty, so fast compression costs little size
+            Image.fromarray(rgba, 'RGBA').save(target_png_path, compress_level=1)
             print(f"Enhanced overlay PNG created at {target_png_path}")
-            return True
+            return True, dataset_folium_bounds(src)
     except Exception as e:
         print(f"Error creating enhanced overlay PNG from {source_tiff_path}: {e}")
-        return False
+        return False, None
 
 # --- Main Script ---
 if __name__ == "__main__":
@@ -154,17 +141,17 @@ if __name__ == "__main__":
         current_alpha = 200
         current_dilation = dilation_amount
 
-    if not create_enhanced_overlay_png(
+    overlay_png_created, overlay_raster_bounds = create_enhanced_overlay_png(
         overlay_tiff_path,
         temp_overlay_png_path,
         color=current_color,
         alpha=current_alpha,
         dilation_iterations=current_dilation
-    ):
+    )
+    if not overlay_png_created:
         print("Failed to create enhanced overlay PNG. Exiting.")
         exit()
 
-    overlay_raster_bounds = get_raster_bounds(overlay_tiff_path)
     if not overlay_raster_bounds:
         print("Could not determine overlay raster bounds. Exiting.")
         exit()
@@ -229,6 +216,10 @@ if __name__ == "__main__":
 
     # ... (Selenium screenshot code, same as before) ...
     if USE_SELENIUM:
+        # Imported only here: Selenium's import graph is large and screenshotting is off by default
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service as ChromeService
         # (Your Selenium code as before)
         # ...
         # Remember to update CHROME_DRIVER_PATH and ensure chromedriver version matches Chrome
@@ -0,0 +1,114 @@
+import numpy as np
+from matplotlib import colormaps # Only the colormap table is needed; the PNGs are written with PIL
+from scipy.ndimage import binary_dilation # For dilation
+from scipy.signal import fftconvolve # For large-radius dilation
+from numba import njit, prange
+
+# Mask dilation and TPI colouring shared by overlay_interfluves_map.py, overlay_interfluves_map_copy.py and
+# amazon_archaeology_map/create_map.py.
+
+# --- Dilation ---
+fft_dilation_min_iterations = 3 # Below this the iterative dilation is cheaper than the FFT setup
+square_dilation = False # True: grow features by a (2k+1) x (2k+1) square instead of the default diamond
+
+def _shift_packed_columns(packed, shift):
+    """Moves the pixels of a row-wise np.packbits array `shift` columns right (shift > 0) or left, filling with 0."""
+    n_bytes = packed.shape[1]
+    byte_shift, bit_shift = divmod(abs(shift), 8)
+    shifted = np.zeros_like(packed)
+    if byte_shift < n_bytes:
+        if shift > 0:
+            shifted[:, byte_shift:] = packed[:, :n_bytes - byte_shift]
+        else:
+            shifted[:, :n_bytes - byte_shift] = packed[:, byte_shift:]
+    if bit_shift:
+        # np.packbits is MSB-first, so bits pushed out of one byte continue into its neighbour
+        carry = np.zeros_like(shifted)
+        if shift > 0:
+            carry[:, 1:] = shifted[:, :-1]
+            shifted = (shifted >> bit_shift) | (carry << (8 - bit_shift))
+        else:
+            carry[:, :-1] = shifted[:, 1:]
+            shifted = (shifted << bit_shift) | (carry >> (8 - bit_shift))
+    return shifted
+
+def _shift_rows(packed, shift):
+    """Moves rows `shift` places down (shift > 0) or up, filling with 0."""
+    shifted = np.zeros_like(packed)
+    n_rows = packed.shape[0]
+    if abs(shift) < n_rows:
+        if shift > 0:
+            shifted[shift:] = packed[:n_rows - shift]
+        else:
+            shifted[:n_rows + shift] = packed[-shift:]
+    return shifted
+
+def _or_shifts(packed, radius, shift_fn, direction):
+    """OR of packed shifted by 0..radius steps in one direction, with log2(radius) shifts by doubling."""
+    covered = 0
+    while covered < radius:
+        step = min(covered + 1, radius - covered)
+        packed = packed | shift_fn(packed, direction * step)
+        covered += step
+    return packed
+
+def dilate_mask(binary_mask, iterations):
+    """
+    Same result as binary_dilation(binary_mask, iterations=iterations) with the default cross structure, i.e. a
+    dilation by the diamond |dy| + |dx| <= iterations. For larger radii this is done as one FFT convolution with
+    that diamond (cost independent of the radius) instead of `iterations` full passes over the raster.
+    With square_dilation the footprint is a square, which is separable into ORs of shifted copies along the
+    columns and then the rows. Those run on the np.packbits form of the mask (8 pixels per byte), with
+    log2(iterations) shifts per direction.
+    """
+    if square_dilation:
+        packed = np.packbits(binary_mask, axis=1)
+        for shift_fn in (_shift_packed_columns, _shift_rows):
+            packed = _or_shifts(packed, iterations, shift_fn, 1)
+            packed = _or_shifts(packed, iterations, shift_fn, -1)
+        return np.unpackbits(packed, axis=1, count=binary_mask.shape[1]).view(np.bool_)
+    if iterations < fft_dilation_min_iterations:
+        return binary_dilation(binary_mask, iterations=iterations)
+    offsets = np.arange(-iterations, iterations + 1)
+    diamond = (np.abs(offsets)[:, None] + np.abs(offsets)[None, :] <= iterations).astype(np.float32)
+    # fftconvolve zero-pads internally (linear, not circular, convolution); 0.5 absorbs FFT round-off
+    return fftconvolve(binary_mask.astype(np.float32), diamond, mode='same') > 0.5
+
+# --- TPI Colormap Kernel ---
+tpi_colormap_lut = colormaps['RdBu_r'](np.arange(colormaps['RdBu_r'].N), bytes=True) # (256, 4) uint8, same table colormap(..., bytes=True) uses
+
+@njit(parallel=True, cache=True)
+def tpi_to_rgba(data, vmin, vmax, lut, alpha_full, alpha_flat, has_nodata, nodata, out):
+    """
+    One pass per pixel of what Normalize(vmin, vmax) + colormap(bytes=True) + the flat-area alpha rule + the
+    nodata mask did as separate full-array passes. Matches matplotlib's binning (index = int(t * N), t = 1 maps
+    to the last entry, out of range clips to the ends) and leaves NaN pixels black like the colormap's bad color.
+    No fastmath, since it would let LLVM drop the NaN tests.
+    """
+    n_colors = lut.shape[0]
+    nrows, ncols = data.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            x = data[i, j]
+            if np.isnan(x):
+                out[i, j, 0] = 0
+                out[i, j, 1] = 0
+                out[i, j, 2] = 0
+                out[i, j, 3] = 0 if (has_nodata and np.isnan(nodata)) else alpha_full
+                continue
+            t = (x - vmin) / (vmax - vmin) * n_colors
+            if t < 0:
+                idx = 0
+            elif t >= n_colors - 1:
+                idx = n_colors - 1
+            else:
+                idx = int(t)
+            out[i, j, 0] = lut[idx, 0]
+            out[i, j, 1] = lut[idx, 1]
+            out[i, j, 2] = lut[idx, 2]
+            if has_nodata and x == nodata:
+                out[i, j, 3] = 0
+            elif abs(x) < 0.25: # Flats are drawn nearly transparent
+                out[i, j, 3] = alpha_flat
+            else:
+                out[i, j, 3] = alpha_full
@@ -1,4 +1,5 @@
-import folium
+import os
+import numpy as np
 
 # Coordinates for São Francisco do Guaporé (Corrected Decimal Degrees)
 # Original: -12° 03' 4.80" S, -63° 34' 1.79" W
@@ -13,35 +14,56 @@ area_centers_for_avg = [
 ]
 
 # 2. Determine a map center and initial zoom level
-all_centers_for_avg = area_centers_for_avg + [sao_francisco_coords]
-map_center_lat = sum(coords[0] for coords in all_centers_for_avg) / len(all_centers_for_avg)
-map_center_lon = sum(coords[1] for coords in all_centers_for_avg) / len(all_centers_for_avg)
-initial_map_center = [map_center_lat, map_center_lon]
+all_centers_for_avg = np.array(area_centers_for_avg + [sao_francisco_coords])
+initial_map_center = all_centers_for_avg.mean(axis=0).tolist() # [lat, lon]
 initial_zoom = 9
 
-# 3. Create a folium.Map object
+# 3. Map tiles
 google_satellite_tiles = "https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}"
 google_attribution = "Google Satellite"
 
-m_clean = folium.Map(
-    location=initial_map_center,
-    zoom_start=initial_zoom,
-    tiles=google_satellite_tiles,
-    attr=google_attribution
-)
+# 4. Render the Leaflet page directly. All inputs are constants, so there is no need to
+# import folium and rebuild its Jinja2 templates on every run.
+sao_francisco_popup = f"<b>{sao_francisco_name}</b><br>Coords: {sao_francisco_coords[0]:.6f}, {sao_francisco_coords[1]:.6f}"
+map_html = f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css">
+    <link rel="stylesheet" href="https://netdna.bootstrapcdn.com/bootstrap/3.0.0/css/bootstrap-glyphicons.css">
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.css">
+    <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.js"></script>
+    <style>html, body, #map {{ width: 100%; height: 100%; margin: 0; padding: 0; }}</style>
+</head>
+<body>
+    <div id="map"></div>
+    <script>
+        var m = L.map('map').setView([{initial_map_center[0]}, {initial_map_center[1]}], {initial_zoom});
+        L.tileLayer('{google_satellite_tiles}', {{attribution: '{google_attribution}'}}).addTo(m);
+        // Orange marker for São Francisco do Guaporé (same icon folium.Icon(color='orange', icon='info-sign') produces)
+        var town_icon = L.AwesomeMarkers.icon({{markerColor: 'orange', icon: 'info-sign', prefix: 'glyphicon'}});
+        L.marker([{sao_francisco_coords[0]}, {sao_francisco_coords[1]}], {{icon: town_icon}}).addTo(m)
+            .bindTooltip('{sao_francisco_name}')
+            .bindPopup('{sao_francisco_popup}');
+    </script>
+</body>
+</html>
+"""
 
-# Add marker for São Francisco do Guaporé
-folium.Marker(
-    location=sao_francisco_coords,
-    tooltip=sao_francisco_name,
-    popup=f"<b>{sao_francisco_name}</b><br>Coords: {sao_francisco_coords[0]:.6f}, {sao_francisco_coords[1]:.6f}",
-    icon=folium.Icon(color='orange', icon='info-sign') # Orange marker
-).add_to(m_clean)
-
-import os # Add os import for makedirs
-# 5. Save the map to a new HTML file
+# 5. Save the map to a new HTML file. The write is skipped only when the file on disk is byte-identical
+# to the page just rendered, so any edit to the constants above is picked up on the next run.
 output_filename_clean = "output_data/maps/amazon_research_areas_map_clean_with_town_corrected.html"
-os.makedirs(os.path.dirname(output_filename_clean), exist_ok=True)
-m_clean.save(output_filename_clean)
-
-print(f"Clean map with corrected town saved to {output_filename_clean}")
+map_html_bytes = map_html.encode("utf-8")
+existing_html_bytes = None
+if os.path.exists(output_filename_clean):
+    with open(output_filename_clean, "rb") as f:
+        existing_html_bytes = f.read()
+if existing_html_bytes != map_html_bytes:
+    os.makedirs(os.path.dirname(output_filename_clean), exist_ok=True)
+    with open(output_filename_clean, "wb") as f:
+        f.write(map_html_bytes)
+    print(f"Clean map with corrected town saved to {output_filename_clean}")
+else:
+    print(f"Clean map with corrected town at {output_filename_clean} is already up to date")
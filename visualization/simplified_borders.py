@@ -0,0 +1,45 @@
+import os
+import json
+import geopandas as gpd
+try:
+    import orjson # Faster GeoJSON parsing when available
+except ImportError:
+    orjson = None
+
+# --- AOI-filtered + simplified copy of the country borders ---
+# Shared by aoi_boxes_map_borders.py and gedi_map_lidar.py.
+# The full Natural Earth file is tens of MB; embedding it makes the HTML huge and slow to draw.
+# The countries whose extent touches the AOI (+/- margin) are simplified and cached next to it, rebuilt if the
+# source changes. They are kept whole, not clipped: clipping would draw the bbox edges as fake border lines.
+border_bbox_margin_deg = 5
+border_simplify_tolerance_deg = 0.01
+
+def get_simplified_borders_path(country_borders_geojson_path, aoi_bounds):
+    """Cached simplified borders around aoi_bounds = (min_lon, min_lat, max_lon, max_lat); built if missing or stale."""
+    min_lon, min_lat, max_lon, max_lat = aoi_bounds
+    border_bbox = (min_lon - border_bbox_margin_deg, min_lat - border_bbox_margin_deg,
+                   max_lon + border_bbox_margin_deg, max_lat + border_bbox_margin_deg)
+    simplified_borders_geojson_path = country_borders_geojson_path.replace(
+        ".geojson", "_bbox_{:g}_{:g}_{:g}_{:g}_simplified.geojson".format(*border_bbox))
+    if (not os.path.exists(simplified_borders_geojson_path)
+            or os.path.getmtime(simplified_borders_geojson_path) < os.path.getmtime(country_borders_geojson_path)):
+        borders = gpd.read_file(country_borders_geojson_path, engine="pyogrio", bbox=border_bbox)
+        borders["geometry"] = borders.geometry.simplify(border_simplify_tolerance_deg, preserve_topology=True)
+        borders.to_file(simplified_borders_geojson_path, driver="GeoJSON", engine="pyogrio")
+        print(f"Simplified country borders cached at {simplified_borders_geojson_path}")
+    return simplified_borders_geojson_path
+
+def load_simplified_borders(country_borders_geojson_path, aoi_bounds):
+    """Simplified borders as a GeoJSON dict with the (unused) feature properties stripped."""
+    with open(get_simplified_borders_path(country_borders_geojson_path, aoi_bounds), "rb") as f:
+        borders_geojson = orjson.loads(f.read()) if orjson is not None else json.loads(f.read())
+    for feature in borders_geojson["features"]:
+        feature["properties"] = {}
+    return borders_geojson
+
+# Constant border style; folium still calls style_function per feature, so it just returns this one dict
+border_style = {
+    'fillOpacity': 0,
+    'weight': 1.5,
+    'color': '#FFFF00' # Bright yellow
+}
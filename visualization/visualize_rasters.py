@@ -1,8 +1,14 @@
 import rasterio
+from rasterio.enums import Resampling
+import math
+import matplotlib
+matplotlib.use('Agg') # Files only; also keeps worker processes off any GUI backend
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,11 +19,27 @@ logger = logging.getLogger(__name__)
 output_maps_dir = "output_data/maps/"
 os.makedirs(output_maps_dir, exist_ok=True)
 
-# --- Helper Function to Plot and Save ---
-def visualize_raster(tiff_path, output_image_path, title, cmap='viridis', vmin_user=None, vmax_user=None, is_binary=False, log_scale_facc=False):
+figure_size_inches = (12, 10) # Slightly wider for colorbar
+output_dpi = 150
+
+# --- Helper Functions to Plot and Save ---
+def create_figure():
+    """Figure, image axes and colorbar axes; created once and reused for every raster."""
+    fig, ax = plt.subplots(1, 1, figsize=figure_size_inches)
+    # Create an axes for the colorbar on the right side
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.1)
+    # No tight_layout: savefig's bbox_inches='tight' already crops to the drawn content, so a layout pass
+    # on top of it only costs an extra render
+    return fig, ax, cax
+
+def visualize_raster(tiff_path, output_image_path, title, cmap='viridis', vmin_user=None, vmax_user=None, is_binary=False, log_scale_facc=False,
+                     figure=None):
     """
     Reads a GeoTIFF, visualizes it, and saves it as a PNG.
     Uses vmin_user and vmax_user for user-specified limits.
+    `figure` is a (fig, ax, cax) tuple from create_figure() to draw into; its axes are cleared and reused.
+    Without it a figure is created for this call and closed afterwards.
     """
     if not os.path.exists(tiff_path):
         logger.error(f"TIFF file not found: {tiff_path}")
@@ -25,10 +47,39 @@ def visualize_raster(tiff_path, output_image_path, title, cmap='viridis', vmin_u
 
     try:
         with rasterio.open(tiff_path) as src:
-            data = src.read(1)
+            # FACC is log-scaled for display, where float32 is ample, so it is read as float32 to halve the bandwidth.
+            # 0/1 masks are read as uint8 whatever their stored type, which imshow handles without a float copy.
+            if is_binary:
+                read_dtype = np.uint8
+            elif log_scale_facc:
+                read_dtype = np.float32
+            else:
+                read_dtype = None
+            # The figure can show at most figure_size * dpi pixels, so larger rasters are read decimated by an
+            # integer factor (GDAL uses overviews if present) instead of loading the full band for matplotlib to
+            # downsample. Integer codes use nearest and floats average. GDAL has no max for plain reads, so masks are
+            # averaged too and any block with a non-zero cell is drawn as 1, which keeps 1-px stream lines.
+            decimation = max(1, math.ceil(max(src.height / (figure_size_inches[1] * output_dpi),
+                                              src.width / (figure_size_inches[0] * output_dpi))))
+            if decimation > 1:
+                if is_binary or np.issubdtype(np.dtype(src.dtypes[0]), np.floating):
+                    resampling = Resampling.average
+                else:
+                    resampling = Resampling.nearest
+                out_shape = (math.ceil(src.height / decimation), math.ceil(src.width / decimation))
+                data = src.read(1, out_shape=out_shape, resampling=resampling,
+                                out_dtype=np.float32 if is_binary else read_dtype)
+                logger.debug(f"Read '{title}' decimated {decimation}x to {out_shape} ({resampling.name})")
+            else:
+                data = src.read(1, out_dtype=read_dtype)
             nodata_val = src.nodatavals[0] if src.nodatavals else None
 
-            if nodata_val is not None:
+            if is_binary:
+                # No masked array: nodata is drawn as 0, which gray_r already renders as the white background
+                if nodata_val is not None and nodata_val != 0 and 0 <= nodata_val <= 255:
+                    data[data == nodata_val] = 0
+                masked_data = (data > 0).view(np.uint8) if data.dtype != np.uint8 else data # Block averages -> 0/1
+            elif nodata_val is not None:
                 if np.issubdtype(data.dtype, np.floating) and np.isnan(nodata_val):
                     masked_data = np.ma.masked_where(np.isnan(data), data)
                 else:
@@ -36,22 +87,32 @@ def visualize_raster(tiff_path, output_image_path, title, cmap='viridis', vmin_u
             else:
                 masked_data = data
 
-            fig, ax = plt.subplots(1, 1, figsize=(12, 10)) # Slightly wider for colorbar
+            if figure is None:
+                fig, ax, cax = create_figure()
+            else:
+                fig, ax, cax = figure
+                ax.cla()
+                cax.cla()
             
             current_vmin = vmin_user
             current_vmax = vmax_user
 
             if is_binary:
-                im = ax.imshow(masked_data, cmap='gray_r', vmin=0, vmax=1)
+                im = ax.imshow(masked_data, cmap='gray_r', vmin=0, vmax=1, interpolation='nearest')
             elif log_scale_facc and 'facc' in tiff_path.lower():
                 # Apply log transformation for flow accumulation
                 # Fill masked (nodata) values with 0 before log1p to avoid issues with mask
-                plot_data_log = np.log1p(np.maximum(0, masked_data.filled(0))) 
+                # (clip and log1p then run in place on that float32 buffer, no further temporaries)
+                plot_data_log = np.ma.filled(masked_data, 0)
+                np.maximum(plot_data_log, 0, out=plot_data_log)
+                np.log1p(plot_data_log, out=plot_data_log)
                 
                 # If vmin_user/vmax_user not specified for FACC, calculate from percentiles
                 if vmin_user is None or vmax_user is None:
-                    # Calculate percentiles on the log-transformed data, excluding true zeros if they dominate
-                    valid_log_data = plot_data_log[plot_data_log > np.log1p(0) + 1e-9] # Exclude values very close to log1p(0)
+                    # Calculate percentiles on the log-transformed data, excluding true zeros if they dominate.
+                    # A strided sample of ~1M pixels gives the same display limits without sorting the whole band.
+                    percentile_sample = plot_data_log.ravel()[::max(1, plot_data_log.size // 1_000_000)]
+                    valid_log_data = percentile_sample[percentile_sample > np.log1p(0) + 1e-9] # Exclude values very close to log1p(0)
                     if valid_log_data.size > 20: # Ensure enough data points for robust percentiles
                         current_vmin = np.percentile(valid_log_data, 2)  # e.g., 2nd percentile as min
                         current_vmax = np.percentile(valid_log_data, 98) # e.g., 98th percentile as max
@@ -79,17 +140,13 @@ def visualize_raster(tiff_path, output_image_path, title, cmap='viridis', vmin_u
             ax.set_axis_off()
             
             # Add colorbar
-            # Create an axes for the colorbar on the right side
-            from mpl_toolkits.axes_grid1 import make_axes_locatable
-            divider = make_axes_locatable(ax)
-            cax = divider.append_axes("right", size="5%", pad=0.1)
             cb = fig.colorbar(im, cax=cax)
             cb.ax.tick_params(labelsize=10)
 
-
-            plt.tight_layout(rect=[0, 0, 0.95, 1]) # Adjust rect to prevent title overlap with suptitle if used
-            plt.savefig(output_image_path, dpi=150, bbox_inches='tight')
-            plt.close(fig)
+            # zlib level 1 instead of matplotlib's default 6: encoding is a large share of savefig time
+            fig.savefig(output_image_path, dpi=output_dpi, bbox_inches='tight', pil_kwargs={'compress_level': 1})
+            if figure is None:
+                plt.close(fig)
             logger.info(f"Saved visualization: {output_image_path}")
 
     except Exception as e:
@@ -108,24 +165,33 @@ tiffs_to_visualize = [
     {"input_path": "output_data/interfluves/combined_interfluves_gee_wbt.tif", "output_name": "combined_interfluves_gee_wbt.png", "title": "Combined Interfluves", "is_binary": True},
 ]
 
+# --- Per-TIFF Worker ---
+# Each worker process draws into its own figure, created on first use and reused for the rasters it gets
+_worker_figure = None
+
+def _viz_one(item):
+    global _worker_figure
+    if _worker_figure is None:
+        _worker_figure = create_figure()
+    visualize_raster(
+        item["input_path"],
+        os.path.join(output_maps_dir, item["output_name"]),
+        item["title"],
+        cmap=item.get("cmap", 'viridis'),
+        vmin_user=item.get("vmin_user"), # Pass user-defined vmin
+        vmax_user=item.get("vmax_user"), # Pass user-defined vmax
+        is_binary=item.get("is_binary", False),
+        log_scale_facc=item.get("log_scale_facc", False),
+        figure=_worker_figure
+    )
+
 # --- Main Loop ---
 if __name__ == "__main__":
     # output_maps_dir is defined in the Configuration section
     logger.info(f"Saving output images to: {output_maps_dir}")
 
-    for item in tiffs_to_visualize:
-        tiff_file_path = item["input_path"]
-        output_png_path = os.path.join(output_maps_dir, item["output_name"])
-        
-        visualize_raster(
-            tiff_file_path,
-            output_png_path,
-            item["title"],
-            cmap=item.get("cmap", 'viridis'),
-            vmin_user=item.get("vmin_user"), # Pass user-defined vmin
-            vmax_user=item.get("vmax_user"), # Pass user-defined vmax
-            is_binary=item.get("is_binary", False),
-            log_scale_facc=item.get("log_scale_facc", False)
-        )
+    # The rasters are independent and rendering/PNG encoding is CPU-bound, so they are drawn in parallel processes
+    with ProcessPoolExecutor(max_workers=min(len(tiffs_to_visualize), os.cpu_count() or 1)) as executor:
+        list(executor.map(_viz_one, tiffs_to_visualize))
     
     logger.info("Visualization script finished.")